@@ -2,10 +2,52 @@
 
 import pandas as pd
 import numpy as np
+from scipy import sparse
+from scipy.optimize import milp, LinearConstraint, Bounds
 import ipywidgets as widgets
-from ipywidgets import interact, fixed
-from ipysheet import sheet, cell, calculation
+from ipysheet import sheet, cell, column, cell_range
+from IPython.display import display
 import pickle
+import asyncio
+import csv
+import glob
+import os
+import itertools
+import xml.etree.ElementTree as ET
+from collections import OrderedDict, deque
+import time
+
+
+# the database (from Brewtarget) stores everything in metric units
+LB_PER_KG = 2.20462262
+OZ_PER_KG = 35.2739619
+L_PER_GAL = 3.78541178
+
+
+# number of computed metrics each BrewBuild keeps around
+METRIC_CACHE_SIZE = 128
+
+# recipe inputs each lazily computed metric depends on. the cache
+# key for a metric is built only from these, so changing an input
+# only invalidates the metrics that actually use it
+METRIC_INPUTS = {
+    'OG': ('grain_bill', 'mash_efficiency', 'target_volume'),
+    'FG': ('grain_bill', 'mash_efficiency', 'target_volume',
+           'mash_temp', 'yeast', 'yeast_atten'),
+    'ABV': ('grain_bill', 'mash_efficiency', 'target_volume',
+            'mash_temp', 'yeast', 'yeast_atten'),
+    'color': ('grain_bill', 'target_volume'),
+    'IBU': ('grain_bill', 'hop_bill', 'mash_efficiency',
+            'boil_volume', 'target_volume'),
+    'MG': ('grain_bill', 'mash_efficiency', 'mash_volume'),
+    'BG': ('grain_bill', 'mash_efficiency', 'boil_volume'),
+    'PB_volume': ('boil_volume', 'boil_time'),
+    'PB': ('grain_bill', 'mash_efficiency', 'boil_volume',
+           'boil_time'),
+    'jacobian': ('grain_bill', 'hop_bill', 'mash_efficiency',
+                 'target_volume', 'boil_volume', 'boil_time',
+                 'mash_temp', 'yeast', 'yeast_atten'),
+}
 
 
 def search_db(con, tab_name, tab_column, keyword):
@@ -49,17 +91,169 @@ def search_db(con, tab_name, tab_column, keyword):
     return df
 
 
-def menu_select(db_table, con):
-    df = pd.read_sql_query("SELECT * FROM %s" % db_table, con)
+class _NameIndex(object):
+    """
+    lower-cased names of a table that can be filtered by substring.
+    Every 1, 2 and 3 character piece (n-gram) of the names is indexed
+    to the rows that contain it, so a query of up to 3 characters is
+    a single lookup and a longer one only checks the rows that have
+    its rarest 3 character piece. Results of the last few queries
+    are also kept (so deleting a character is free)
+    """
+
+    def __init__(self, names, history=16, chunk_size=100000):
+        names = pd.Series(names).fillna('').str.lower()
+        self.names = np.array([n.encode('utf-8') for n in names], dtype='S')
+        self.history = history
+        self.results = OrderedDict([('', np.arange(len(self.names)))])
+
+        # names as a (rows, bytes) array padded with 0s
+        width = max(self.names.dtype.itemsize, 1)
+        chars = np.frombuffer(self.names.tobytes(), dtype=np.uint8).reshape(-1, width)
+        lengths = np.char.str_len(self.names)
+        self.grams = {n: self._postings(chars, lengths, n, chunk_size) for n in (1, 2, 3)}
+
+    @staticmethod
+    def _postings(chars, lengths, n, chunk_size):
+        """
+        index the n character pieces of every name, giving the sorted
+        piece codes, offsets into rows (like a CSR matrix) and the rows
+        """
+        width = chars.shape[1]
+        if width < n:
+            return np.zeros(0, np.int64), np.zeros(1, np.int64), np.zeros(0, np.int64)
+        keys = []
+        for start in range(0, len(chars), chunk_size):
+            block = chars[start:start + chunk_size]
+            codes = block[:, :width - n + 1].astype(np.int64)
+            for k in range(1, n):
+                codes = codes * 256 + block[:, k:width - n + 1 + k]
+            valid = np.arange(width - n + 1) <= (lengths[start:start + chunk_size, None] - n)
+            rows, cols = np.nonzero(valid)
+            # piece code and row packed into one number, so sorting
+            # groups rows by piece and drops repeats in one go
+            keys.append(codes[rows, cols] * len(chars) + rows + start)
+        keys = np.sort(np.concatenate(keys))
+        keys = keys[np.append(True, np.diff(keys) != 0)]
+        codes, rows = np.divmod(keys, max(len(chars), 1))
+        starts = np.flatnonzero(np.append(True, np.diff(codes) != 0))
+        return codes[starts], np.append(starts, len(rows)), rows
+
+    def _rows(self, gram):
+        """
+        rows whose name contains a 1 to 3 character piece
+        """
+        code = 0
+        for c in gram:
+            code = code * 256 + c
+        codes, offsets, rows = self.grams[len(gram)]
+        i = np.searchsorted(codes, code)
+        if i == len(codes) or codes[i] != code:
+            return rows[:0]
+        return rows[offsets[i]:offsets[i + 1]]
+
+    def filter(self, query):
+        """
+        get the row numbers of names that contain query
+        """
+        query = query.lower()
+        if query in self.results:
+            self.results.move_to_end(query)
+            return self.results[query]
+
+        q = query.encode('utf-8')
+        if len(q) <= 3:
+            found = self._rows(q)
+        else:
+            # only rows with the rarest piece of the query can match
+            found = min((self._rows(q[i:i + 3]) for i in range(len(q) - 2)), key=len)
+            found = found[np.char.find(self.names[found], q) >= 0]
+
+        self.results[query] = found
+        if len(self.results) > self.history:
+            # never drop the full table stored under ''
+            oldest = next(q for q in self.results if q != '')
+            del self.results[oldest]
+        return found
+
+
+def _debounce(wait):
+    """
+    delay a widget callback until wait seconds have passed
+    without it being called again. Based on the example in
+    https://ipywidgets.readthedocs.io/en/stable/examples/Widget%20Events.html
+    """
+    def decorator(fn):
+        timer = [None]
+
+        def debounced(*args, **kwargs):
+            if timer[0] is not None:
+                timer[0].cancel()
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                # no event loop (outside a kernel), so just run it
+                fn(*args, **kwargs)
+                return
+            timer[0] = loop.call_later(wait, lambda: fn(*args, **kwargs))
+        return debounced
+    return decorator
+
+
+def menu_select(db_table, con, max_rows=20, wait=0.02, timings=None):
+    """"
+    interactive search of a table in db by name
+
+    Parameters
+    ---------
+
+    db_table: str
+        name of the table you are searching
+
+    con: sqlite3 connection
+        sqlite3 connection to a database
 
-    def print_df(name, df):
-        return df[df['name'].str.lower().str.contains(name.lower())]
+    max_rows: int
+        most rows shown at once (rendering the table is most
+        of the time each update takes)
 
-    interact(print_df, name=widgets.Text(value='Dry',
-                                         placeholder='Type something',
-                                         description='%s:' % db_table,
-                                         disabled=False),
-             df=fixed(df))
+    wait: float
+        seconds to wait after the last keystroke before updating
+
+    timings: list
+        if given, a dict of times (in seconds) is added for each
+        update: 'filter', 'display' and 'total' from the keystroke
+        until the output was sent (including the wait). Browser
+        render time is not included
+    """
+    df = pd.read_sql_query("SELECT * FROM %s" % db_table, con)
+    index = _NameIndex(df['name'])
+
+    text = widgets.Text(value='Dry',
+                        placeholder='Type something',
+                        description='%s:' % db_table,
+                        disabled=False)
+    out = widgets.Output()
+
+    def print_df(name, typed=None):
+        start = time.perf_counter()
+        rows = index.filter(name)
+        filtered = time.perf_counter()
+        out.clear_output(wait=True)
+        with out:
+            display(df.iloc[rows[:max_rows]])
+            if len(rows) > max_rows:
+                print('showing %d of %d matches' % (max_rows, len(rows)))
+        if timings is not None:
+            end = time.perf_counter()
+            timings.append({'filter': filtered - start, 'display': end - filtered,
+                            'total': end - (start if typed is None else typed)})
+
+    update = _debounce(wait)(print_df)
+    text.observe(lambda change: update(change['new'], time.perf_counter()),
+                 names='value')
+    print_df(text.value)
+    display(widgets.VBox([text, out]))
 
 
 def add_row_table(con, table_name, columns, values):
@@ -149,9 +343,22 @@ class BrewBuild(object):
     mash_volume: float
         volume of water in mash in gallons
 
+    tables: dict
+        optional dict of pandas.DataFrames of the fermentable,
+        hop, yeast and style tables indexed by id (see
+        load_tables). If given, the database info for the recipe
+        is taken from these instead of querying con, which is
+        much faster when building many BrewBuild objects
+
     Atttributes
     -----------
 
+    NOTE: OG, FG, color, IBU, ABV, MG, BG, PB and PB_volume
+          are computed lazily the first time they are read and
+          cached based on the recipe inputs they depend on, so
+          they always reflect the current grain_bill, hop_bill
+          and volumes (even if the bills are edited in place)
+
     OG: float
         original gravity of beer
 
@@ -176,6 +383,10 @@ class BrewBuild(object):
     df_yeast: pandas.DataFrame
         dataframe with database info on yeast selected
 
+    yeast_atten: float
+        attenuation of the yeast (from df_yeast, so it includes
+        any edit made in the interactive sheet)
+
     df_style: pandas.DataFrame
         dataframe with database info on style selected
 
@@ -192,6 +403,10 @@ class BrewBuild(object):
     PB_volume: float
         post-boil volume of wort
 
+    jacobian: pandas.DataFrame
+        partial derivatives of the recipe metrics with respect
+        to the recipe inputs (see calc_jacobian)
+
     Methods
     -------
 
@@ -234,6 +449,29 @@ class BrewBuild(object):
     calc_PB_grav():
         calculate the gravity post-boil
 
+    calc_jacobian():
+        calculate the partial derivatives of the recipe
+        metrics with respect to the recipe inputs
+
+    calc_step_mash(mash_id):
+        run a multi-step mash schedule from the database
+        against the grain bill
+
+    calc_water(water, salts):
+        calculate the ion profile, residual alkalinity and
+        mash pH for some brewing water and salt additions
+
+    correct_brew_day(measured_MG, measured_BG, measured_volume):
+        solve the actual mash efficiency from brew day
+        measurements and the corrections to hit the target
+
+    refresh_ingredients():
+        reload the database info for the grain and hop bill
+        (and the yeast if it changed)
+
+    clear_metric_cache():
+        drop all cached metrics so they are recomputed on next read
+
     build_recipe(name):
         do all calculations and build out recipe. Results
         are outputted to a csv file
@@ -241,15 +479,16 @@ class BrewBuild(object):
     interactive_sheet():
         create an ipywidget that is an interactive spreadsheet
 
-    update_recipe_from_sheet(sheet, name):
+    update_recipe_from_sheet(sheet, name, history):
         take any updates from ipysheet and adjust variables in
         BrewBuild object and redo the recipe outputted to another
-        csv
+        csv (and optionally add it to a RecipeHistory)
     """
 
     def __init__(self, grain_bill, hop_bill, yeast, target_volume,
                  boil_volume, mash_temp, con, boil_time=60,
-                 mash_efficiency=70, style=None, mash_volume=1):
+                 mash_efficiency=70, style=None, mash_volume=1,
+                 tables=None):
         self.grain_bill = grain_bill
         self.hop_bill = hop_bill
         self.yeast = yeast
@@ -261,16 +500,43 @@ class BrewBuild(object):
         self.mash_efficiency = mash_efficiency
         self.style = style
         self.mash_volume = mash_volume
+        self.tables = tables
 
-        self.OG = None
-        self.FG = None
-        self.color = None
-        self.IBU = None
-        self.ABV = None
+        self._metric_cache = OrderedDict()
+        # bumped whenever the ingredient info from the database
+        # changes, as that is not part of the recipe inputs
+        self._ingredient_version = 0
 
         # create dataframes for each bill
         # doing this will let me change them then
         # before building the recipe
+        self.refresh_ingredients()
+
+        if self.style is not None:
+            if self.tables is not None:
+                self.df_style = _table_rows(self.tables, 'style', [self.style])
+            else:
+                sql_query = "SELECT * FROM style as s WHERE s.id = "
+                sql_query += str(self.style)
+                self.df_style = pd.read_sql_query(sql_query, self.con)
+
+    def refresh_ingredients(self):
+        """
+        reload the database info for the grain and hop bill (and the
+        yeast, if it was changed) and invalidate any metrics that were
+        computed with the old info. An edited attenuation of the same
+        yeast is kept
+        """
+        self._load_yeast()
+
+        if self.tables is not None:
+            ids = np.unique(np.asarray(self.grain_bill)[:, 0].astype(int))
+            self.df_grain_bill = _table_rows(self.tables, 'fermentable', ids)
+            ids = np.unique(np.asarray(self.hop_bill)[:, 0].astype(int))
+            self.df_hop_bill = _table_rows(self.tables, 'hop', ids)
+            self._ingredient_version += 1
+            return
+
         sql_query = "SELECT * FROM fermentable as f WHERE f.id = "
         for i in range(len(self.grain_bill)):
             sql_query += str(self.grain_bill[i][0])
@@ -278,10 +544,6 @@ class BrewBuild(object):
                 sql_query += " or f.id = "
         self.df_grain_bill = pd.read_sql_query(sql_query, self.con)
 
-        sql_query = "SELECT * FROM yeast as y WHERE y.id = "
-        sql_query += str(self.yeast)
-        self.df_yeast = pd.read_sql_query(sql_query, self.con)
-
         sql_query = "SELECT * FROM hop as h WHERE h.id = "
         for i in range(len(self.hop_bill)):
             sql_query += str(self.hop_bill[i][0])
@@ -289,16 +551,104 @@ class BrewBuild(object):
                 sql_query += " or h.id = "
         self.df_hop_bill = pd.read_sql_query(sql_query, self.con)
 
-        if self.style is not None:
-            sql_query = "SELECT * FROM style as s WHERE s.id = "
-            sql_query += str(self.style)
-            self.df_style = pd.read_sql_query(sql_query, self.con)
+        self._ingredient_version += 1
+
+    def _load_yeast(self):
+        """
+        load the database info for the yeast if it is not loaded
+        yet or self.yeast was changed
+        """
+        if hasattr(self, 'df_yeast') and self.df_yeast.loc[0, 'id'] == self.yeast:
+            return
+        if self.tables is not None:
+            self.df_yeast = _table_rows(self.tables, 'yeast', [self.yeast])
+        else:
+            sql_query = "SELECT * FROM yeast as y WHERE y.id = "
+            sql_query += str(self.yeast)
+            self.df_yeast = pd.read_sql_query(sql_query, self.con)
+
+    def clear_metric_cache(self):
+        """
+        drop all cached metrics. only needed if df_grain_bill,
+        df_hop_bill or df_yeast were edited by hand
+        """
+        self._metric_cache.clear()
+        self._ingredient_version += 1
 
-        # add variables for brew day values
-        self.MG = None
-        self.BG = None
-        self.PB = None
-        self.PB_volume = None
+    def _metric_key(self, name):
+        """
+        build the cache key for a metric from the inputs it depends on
+        """
+        key = [name, self._ingredient_version]
+        for attr in METRIC_INPUTS[name]:
+            value = getattr(self, attr)
+            if isinstance(value, (np.ndarray, list)):
+                value = np.asarray(value)
+                value = (value.shape, value.tobytes())
+            key.append(value)
+        return tuple(key)
+
+    def _cached_metric(self, name, func):
+        """
+        get a metric from the LRU cache, computing it with func on a miss
+        """
+        key = self._metric_key(name)
+        if key in self._metric_cache:
+            self._metric_cache.move_to_end(key)
+            return self._metric_cache[key]
+        value = func()
+        self._metric_cache[key] = value
+        if len(self._metric_cache) > METRIC_CACHE_SIZE:
+            self._metric_cache.popitem(last=False)
+        return value
+
+    @property
+    def yeast_atten(self):
+        # part of the FG/ABV cache keys, so a new yeast id is
+        # loaded here before those are computed
+        self._load_yeast()
+        return float(self.df_yeast.loc[0, 'attenuation'])
+
+    @property
+    def OG(self):
+        return self._cached_metric('OG', self.calc_OG)
+
+    @property
+    def FG(self):
+        return self._cached_metric('FG', self.calc_FG)
+
+    @property
+    def ABV(self):
+        return self._cached_metric('ABV',
+                                   lambda: self.calc_ABV(self.OG, self.FG))
+
+    @property
+    def color(self):
+        return self._cached_metric('color', self.calc_color)
+
+    @property
+    def IBU(self):
+        return self._cached_metric('IBU', self.calc_IBU)
+
+    @property
+    def MG(self):
+        return self._cached_metric('MG', self.calc_mash_grav)
+
+    @property
+    def BG(self):
+        return self._cached_metric('BG', self.calc_BG)
+
+    @property
+    def PB_volume(self):
+        return self._cached_metric('PB_volume', self.calc_PB_volume)
+
+    @property
+    def PB(self):
+        return self._cached_metric('PB', self.calc_PB_grav)
+
+    @property
+    def jacobian(self):
+        return self._cached_metric('jacobian', self.calc_jacobian)
 
     def calc_GU(self, grain_amounts, grain_yield,
                 mash_efficiency, grain_type,
@@ -363,8 +713,6 @@ class BrewBuild(object):
         calculate the final gravity of recipie
         """
         if OG is None:
-            if self.OG is None:
-                self.OG = self.calc_OG()
             OG_GU = (self.OG - 1) * 1000
             yeast_atten = self.df_yeast.loc[0, 'attenuation']
             mash_temp = self.mash_temp
@@ -550,20 +898,115 @@ class BrewBuild(object):
         PB = PB_GU / 1000 + 1
         return round(PB, 3)
 
+    def calc_jacobian(self):
+        """
+        calculate the exact partial derivatives of OG, FG, ABV, IBU,
+        color (SRM), BG and PB with respect to every grain amount, hop
+        amount, hop time, mash efficiency, volume, boil time and mash
+        temp. These are derivatives of the formulas in the calc_*
+        methods before any rounding
+
+        Output
+        ------
+
+        jac: pandas.DataFrame
+            one row per metric and one column per input, where grain
+            and hop columns are numbered by row in grain_bill/hop_bill
+            (e.g. 'grain_amount_0', 'hop_time_1')
+        """
+        grain_amounts = self.grain_bill[:, 1].astype(float)
+        mashed = self.grain_bill[:, 2] == 0
+        hop_amounts = self.hop_bill[:, 1].astype(float)
+        hop_times = self.hop_bill[:, 2].astype(float)
+        grain_db = self.df_grain_bill.set_index('id')
+        grain_yield = grain_db['yield'].reindex(self.grain_bill[:, 0]).to_numpy()
+        grain_color = grain_db['color'].reindex(self.grain_bill[:, 0]).to_numpy()
+        alpha = self.df_hop_bill.set_index('id')['alpha'].reindex(self.hop_bill[:, 0]).to_numpy()
+        yeast_atten = self.df_yeast.loc[0, 'attenuation']
+        yeast_atten_adj = self.calc_AA()
+        eff = self.mash_efficiency / 100
+        V_t = self.target_volume
+        V_b = self.boil_volume
+        V_pb = self.calc_PB_volume()
+
+        # gravity units per lb of each grain (see calc_GU) and the
+        # part of them left after fermenting (see calc_FG)
+        points = (grain_yield / 100) * 46
+        GU_per_lb = np.where(mashed, points * eff, points)
+        left_per_lb = np.where(mashed, points * eff * (1 - yeast_atten_adj / 100),
+                               points * (1 - yeast_atten / 100))
+        GU = np.sum(grain_amounts * GU_per_lb)
+        GU_left = np.sum(grain_amounts * left_per_lb)
+        mash_points = np.sum(grain_amounts[mashed] * points[mashed]) / 100
+
+        n_grain, n_hop = len(grain_amounts), len(hop_amounts)
+        columns = (['grain_amount_%d' % i for i in range(n_grain)] +
+                   ['hop_amount_%d' % i for i in range(n_hop)] +
+                   ['hop_time_%d' % i for i in range(n_hop)] +
+                   ['mash_efficiency', 'target_volume', 'boil_volume',
+                    'boil_time', 'mash_temp'])
+        metrics = ['OG', 'FG', 'ABV', 'IBU', 'color', 'BG', 'PB']
+        OG, FG, ABV, IBU, SRM, BG, PB = range(len(metrics))
+        jac = np.zeros((len(metrics), len(columns)))
+        grain = slice(0, n_grain)
+        hop_amount = slice(n_grain, n_grain + n_hop)
+        hop_time = slice(n_grain + n_hop, n_grain + 2 * n_hop)
+        EFF, V_T, V_B, TIME, TEMP = range(n_grain + 2 * n_hop, len(columns))
+
+        # OG = 1 + GU / (1000 V_t)
+        jac[OG, grain] = GU_per_lb / (1000 * V_t)
+        jac[OG, EFF] = mash_points / (1000 * V_t)
+        jac[OG, V_T] = -GU / (1000 * V_t ** 2)
+
+        # FG = 1 + GU_left / (1000 V_t), mash temp only moves
+        # the attenuation of the mashed grains
+        jac[FG, grain] = left_per_lb / (1000 * V_t)
+        jac[FG, EFF] = mash_points * (1 - yeast_atten_adj / 100) / (1000 * V_t)
+        jac[FG, V_T] = -GU_left / (1000 * V_t ** 2)
+        jac[FG, TEMP] = mash_points * eff * 1.25 / (1000 * V_t)
+
+        jac[ABV] = 131.25 * (jac[OG] - jac[FG])
+
+        # SRM = 1.4922 MCU ^ 0.6859
+        MCU = np.sum(grain_amounts * grain_color) / V_t
+        dSRM_dMCU = 1.4922 * 0.6859 * MCU ** (0.6859 - 1) if MCU > 0 else 0.
+        jac[SRM, grain] = dSRM_dMCU * grain_color / V_t
+        jac[SRM, V_T] = -dSRM_dMCU * MCU / V_t
+
+        # BG = 1 + GU / (1000 V_b)
+        jac[BG, grain] = GU_per_lb / (1000 * V_b)
+        jac[BG, EFF] = mash_points / (1000 * V_b)
+        jac[BG, V_B] = -GU / (1000 * V_b ** 2)
+
+        # PB = 1 + GU / (1000 (V_b - 0.75 boil_time / 60))
+        jac[PB, grain] = GU_per_lb / (1000 * V_pb)
+        jac[PB, EFF] = mash_points / (1000 * V_pb)
+        jac[PB, V_B] = -GU / (1000 * V_pb ** 2)
+        jac[PB, TIME] = GU / (1000 * V_pb ** 2) * 0.75 / 60
+
+        # IBU, see est_hop_IBU. BG moves both the utilization
+        # and the gravity correction
+        boil_grav = 1 + GU / (1000 * V_b)
+        fG = 1.65 * 0.000125 ** (boil_grav - 1)
+        fT = (1 - np.exp(-0.04 * hop_times)) / 4.15
+        C_grav = 1 + ((boil_grav - 1.050) / 0.2)
+        IBU_per_oz = (alpha / 100) * fG * fT * 7489 / (V_t * C_grav)
+        total_IBU = np.sum(hop_amounts * IBU_per_oz)
+        dIBU_dBG = total_IBU * (np.log(0.000125) - 5 / C_grav)
+        jac[IBU, hop_amount] = IBU_per_oz
+        jac[IBU, hop_time] = (hop_amounts * (alpha / 100) * fG * 0.04 *
+                              np.exp(-0.04 * hop_times) / 4.15 * 7489 / (V_t * C_grav))
+        jac[IBU, V_T] = -total_IBU / V_t
+        jac[IBU] += dIBU_dBG * jac[BG]
+
+        return pd.DataFrame(jac, index=metrics, columns=columns)
+
     def build_recipe(self, name):
         """
         build the recipe and write it to a csv with name
         """
 
-        self.OG = self.calc_OG()
-        self.FG = self.calc_FG()
-        self.color = self.calc_color()
-        self.IBU = self.calc_IBU()
-        self.ABV = self.calc_ABV(self.OG, self.FG)
-
-        BG = self.calc_BG()
-        BG_GU = (BG - 1) * 1000
-        self.BG = BG
+        BG = self.BG
 
         with open('recipe_template.csv', 'r') as ft, open(name, 'w') as fw:
             i = 0
@@ -654,42 +1097,158 @@ class BrewBuild(object):
                     if i == 17:
                         line[1] = str(self.mash_volume)
                     if i == 18:
-                        MG = self.calc_mash_grav()
-                        self.MG = round(MG, 3)
-                        line[1] = str(round(MG, 3))
+                        line[1] = str(self.MG)
                     if i == 19:
                         line[1] = str(round(BG, 3))
                     if i == 20:
-                        self.PB_volume = self.calc_PB_volume()
                         line[1] = str(self.PB_volume)
                     if i == 21:
-                        self.PB = self.calc_PB_grav()
                         line[1] = str(self.PB)
                 # write to new file
                 fw.write(",".join(line))
 
+    def calc_step_mash(self, mash_id, grain_temp=None, infuse_temp=None):
+        """
+        run a multi-step mash schedule from the mash and mashstep
+        tables against the mashed part of the grain bill
+
+        Parameters
+        ----------
+
+        mash_id: int
+            id of the mash in the mash table
+
+        grain_temp: float
+            temperature of the grain in F. If None, the grain_temp
+            stored with the mash is used
+
+        infuse_temp: float
+            temperature (F) of the water used for infusions after the
+            strike. If given, the infusion volumes are solved for
+            instead of using the ones stored in the database
+
+        Output
+        ------
+
+        mash: dict
+            output of calc_step_mash for this recipe, plus 'atten_adj',
+            the apparent attenuation for the step-weighted mash temp
+        """
+        schedule = load_mash_schedules(self.con, [mash_id])
+        if grain_temp is None:
+            grain_temp = schedule['grain_temp'][0]
+
+        mashed = self.grain_bill[:, 2] == 0
+        grain_weight = self.grain_bill[mashed, 1].sum()
+        mash_GU = 0
+        for i in np.where(mashed)[0]:
+            idx = self.df_grain_bill.index[self.df_grain_bill['id'] == self.grain_bill[i][0]].to_list()[0]
+            mash_GU += self.calc_GU(self.grain_bill[i][1],
+                                    self.df_grain_bill.loc[idx, 'yield'],
+                                    self.mash_efficiency,
+                                    self.grain_bill[i][2])
+
+        mash = calc_step_mash(schedule['step_temp'][0],
+                              schedule['step_time'][0],
+                              schedule['infuse_volume'][0],
+                              grain_weight, mash_GU=mash_GU,
+                              grain_temp=grain_temp,
+                              infuse_temp=infuse_temp)
+        mash['atten_adj'] = self.calc_AA(yeast_atten=self.df_yeast.loc[0, 'attenuation'],
+                                         mash_temp=mash['mash_temp'])
+        return mash
+
+    def calc_water(self, water, salts=None):
+        """
+        calculate the ion profile, residual alkalinity and predicted
+        mash pH for brewing water (plus any salt additions) with this
+        grain bill. The mash volume is used as the water volume
+
+        Parameters
+        ----------
+
+        water: np.array
+            ion profile (ppm) of the source water, in the order of
+            WATER_IONS. Can be of size (P, 6) for P water profiles,
+            e.g. load_water_profiles(con)[WATER_IONS].to_numpy()
+
+        salts: np.array
+            grams per gallon of each salt in WATER_SALTS. Can be of
+            size (P, n_salts) to match the water profiles
+
+        Output
+        ------
+
+        water: dict
+            'profile' (ppm), 'RA' (ppm as CaCO3) and 'pH'
+        """
+        mashed = self.grain_bill[:, 2] == 0
+        grain_db = self.df_grain_bill.set_index('id')
+        color = grain_db['color'].reindex(self.grain_bill[mashed, 0]).to_numpy()
+        amounts = self.grain_bill[mashed, 1].astype(float)
+
+        profile = calc_water_profile(water, salts)
+        RA = calc_residual_alkalinity(profile)
+        pH = calc_mash_pH(RA, amounts.sum(), calc_grain_acidity(amounts, color),
+                          self.mash_volume)
+        return {'profile': profile, 'RA': RA, 'pH': pH}
+
+    def correct_brew_day(self, measured_MG=np.nan, measured_BG=np.nan,
+                         measured_volume=np.nan, extract_yield=95.,
+                         use_extract=True):
+        """
+        solve the actual mash efficiency from brew day measurements
+        (post-mash gravity, pre-boil gravity and volume in gallons) and
+        work out the extract, top-up water or extra boil time needed to
+        hit the target OG and volume (see RecipeBatch.correct_brew_day)
+
+        Output
+        ------
+
+        correction: pandas.Series
+            planned MG, BG and PB_volume, mash_efficiency, extract_amount,
+            top_up_volume, boil_time_change, final_volume and the
+            re-projected OG, FG, ABV and IBU
+        """
+        batch = RecipeBatch.from_brews([self])
+        df = batch.correct_brew_day(measured_MG=measured_MG, measured_BG=measured_BG,
+                                    measured_volume=measured_volume,
+                                    extract_yield=extract_yield, use_extract=use_extract)
+        return df.iloc[0]
+
     def interactive_sheet(self):
         """
         create interactive sheet to open in notebook
 
         NOTES
         -----
-        right now, this just changes the summary table.
-        cant really change the cells for indivdual GU and
-        IBUS for fermentable and hops table (not big deal though)
+        every edit recomputes all outputs (summary, style checks,
+        brew day values and the GU and IBU of each ingredient)
+        once. All outputs are a single range of cells, so an edit
+        that changes any of them is sent to the front end in one
+        message. The kernel side time of each edit is kept in
+        self.sheet_timings ('compute' for the calculations and 'send'
+        for setting the outputs). This does not include the time the
+        browser takes to render them
         """
 
         # create a sheet with all the info from the template
         df = pd.read_csv('recipe_template.csv', names=np.arange(0, 20, 1)).replace(np.nan, '', regex=True)
 
         sheet1 = sheet(rows=len(df), columns=len(df.columns))
+        # all outputs are one range of cells from row 2, column 1 on,
+        # so an edit is sent to the front end in one message. Where
+        # the range has None the front end keeps the cell under it, so
+        # it is added first and the other cells are drawn over it
+        out_rows = max(len(df), len(self.grain_bill) + 2, len(self.hop_bill) + 2) - 2
+        cell_outputs = cell_range([[None] * 17 for _ in range(out_rows)],
+                                  row_start=2, column_start=1)
         for i in range(len(df)):
             for j in range(len(df.columns)):
                 if df.iloc[i, j] != '':
                     cell(i, j, df.iloc[i, j])
         # add in cells now
         cell_ferms = []
-        cell_OG_GU = []
         for i in range(len(self.grain_bill)):
             idx = self.df_grain_bill.index[self.df_grain_bill['id'] == self.grain_bill[i][0]].to_list()[0]
             cell(i + 2, 5, self.df_grain_bill.loc[idx, 'name'])
@@ -699,12 +1258,7 @@ class BrewBuild(object):
                 cell(i + 2, 7, 'Mash')
             else:
                 cell(i + 2, 7, 'Extract')
-            OG_GU = self.calc_GU(self.grain_bill[i][1],
-                                 self.df_grain_bill.loc[idx, 'yield'],
-                                 self.mash_efficiency,
-                                 self.grain_bill[i][2])
-            globals()['cell_OG_GU_%s' % i] = cell(i + 2, 8, int(round(OG_GU / self.target_volume, 0)))
-            cell_OG_GU.append(globals()['cell_OG_GU_%s' % i])
+        grain_yield = self.df_grain_bill.set_index('id')['yield'].reindex(self.grain_bill[:, 0]).to_numpy()
 
         cell_ams = []
         cell_times = []
@@ -715,16 +1269,15 @@ class BrewBuild(object):
             cell_ams.append(globals()['cell_ams_%s' % i])
             globals()['cell_times_%s' % i] = cell(i + 2, 12, self.hop_bill[i][2], background_color = 'yellow')
             cell_times.append(globals()['cell_times_%s' % i])
-            IBU = self.est_hop_IBU(self.BG,
-                                   self.hop_bill[i][2],
-                                   self.hop_bill[i][1],
-                                   self.df_hop_bill.loc[idx, 'alpha'],
-                                   self.target_volume)
-            cell(i + 2, 13, round(IBU, 1))
+        hop_alpha = self.df_hop_bill.set_index('id')['alpha'].reindex(self.hop_bill[:, 0]).to_numpy()
+
+        # cells without a value give the outputs their type and color
+        column(8, [None] * len(self.grain_bill), row_start=2, type='numeric')
+        column(13, [None] * len(self.hop_bill), row_start=2, type='numeric')
 
         cell_yeast_name = cell(2, 15, self.df_yeast.loc[0, 'name'])
         cell_yeast_atten = cell(2, 16, self.df_yeast.loc[0, 'attenuation'], background_color = 'yellow')
-        cell_yeast_atten_adj = cell(2, 17, self.calc_AA(), background_color = 'red')
+        cell(2, 17, None, type='numeric', background_color = 'red')
         cell_yeast_min_temp = cell(2, 18, self.df_yeast.loc[0, 'min_temperature'] * 9 / 5 + 32)
         cell_yeast_max_temp = cell(2, 19, self.df_yeast.loc[0, 'max_temperature'] * 9 / 5 + 32)
 
@@ -732,49 +1285,15 @@ class BrewBuild(object):
         cell_boil_volume = cell(3, 1, self.boil_volume, background_color = 'yellow')
         cell_boil_time = cell(4, 1, self.boil_time, background_color='yellow')
         cell_mash_temp = cell(5, 1, self.mash_temp, background_color = 'yellow')
-        cell_OG = cell(6, 1, self.OG, background_color = 'red')
-        cell_FG = cell(7, 1, self.FG, background_color = 'red')
-        cell_IBU = cell(8, 1, self.IBU, background_color = 'red')
-        cell_color = cell(9, 1, self.color, background_color = 'red')
+        # OG, FG, IBU and color
+        column(1, [None] * 4, row_start=6, type='numeric', background_color='red')
         cell_mash_efficiency = cell(10, 1, self.mash_efficiency, background_color = 'yellow')
-        cell_ABV =cell(11, 1, self.ABV, background_color = 'red')
+        cell(11, 1, None, type='numeric', background_color = 'red')
 
         # brew day cells
         cell_mash_volume = cell(16, 1, self.mash_volume, background_color='yellow')
-        cell_mash_grav = cell(17, 1, background_color='red')
-        @calculation(inputs=cell_ferms + [cell_mash_efficiency, cell_mash_volume], output=cell_mash_grav)
-        def cell_calc_mash_grav(*args):
-            cell_mash_efficiency = args[-2]
-            cell_mash_volume = args[-1]
-            MG = self.calc_mash_grav(grain_amounts=args[:-2],
-                                     mash_efficiency=cell_mash_efficiency,
-                                     mash_volume=cell_mash_volume)
-            return MG
-
-        cell_BG = cell(18, 1, background_color='red')
-        @calculation(inputs=cell_ferms + [cell_mash_efficiency, cell_boil_volume], output=cell_BG)
-        def cell_calc_BG(*args):
-            cell_mash_efficiency = args[-2]
-            cell_boil_volume = args[-1]
-            BG = self.calc_BG(grain_amounts=args[:-2],
-                              mash_efficiency=cell_mash_efficiency,
-                              boil_volume=cell_boil_volume)
-            return BG
-
-        cell_PB_volume = cell(19, 1, background_color='red')
-        @calculation(inputs=[cell_boil_volume, cell_boil_time], output=cell_PB_volume)
-        def cell_calc_PB_volume(cell_boil_volume, cell_boil_time):
-            PB_volume = self.calc_PB_volume(boil_volume=cell_boil_volume,
-                                            boil_time=cell_boil_time)
-            return PB_volume
-
-        cell_PB_grav = cell(20, 1, background_color='red')
-        @calculation(inputs=[cell_BG, cell_boil_volume, cell_boil_time], output=cell_PB_grav)
-        def calc_PB_grav(cell_BG, cell_boil_volume, cell_boil_time):
-            PB = self.calc_PB_grav(BG=cell_BG,
-                                   boil_volume=cell_boil_volume,
-                                   boil_time=cell_boil_time)
-            return PB
+        # mash gravity, pre-boil gravity, post-boil volume and gravity
+        column(1, [None] * 4, row_start=17, type='numeric', background_color='red')
 
         # add style cells
         cell_OG_style = cell(6, 2, str(self.df_style.loc[0, 'og_min']) + '-' + str(self.df_style.loc[0, 'og_max']))
@@ -782,100 +1301,99 @@ class BrewBuild(object):
         cell_IBU_style = cell(8, 2, str(self.df_style.loc[0, 'ibu_min']) + '-' + str(self.df_style.loc[0, 'ibu_max']))
         cell_color_style = cell(9, 2, str(self.df_style.loc[0, 'color_min']) + '-' + str(self.df_style.loc[0, 'color_max']))
         cell_ABV_style = cell(11, 2, str(self.df_style.loc[0, 'abv_min']) + '-' + str(self.df_style.loc[0, 'abv_max']))
-        # add checks for style
-        cell_OG_style_check = cell(6, 3, background_color='red')
-        @calculation(inputs=[cell_OG], output=cell_OG_style_check)
-        def OG_check(cell_OG):
-            if cell_OG < self.df_style.loc[0, 'og_min'] or cell_OG > self.df_style.loc[0, 'og_max']:
-                return 'X'
-            else:
-                return ''
-        cell_FG_style_check = cell(7, 3, background_color='red')
-        @calculation(inputs=[cell_FG], output=cell_FG_style_check)
-        def FG_check(cell_FG):
-            if cell_FG < self.df_style.loc[0, 'fg_min'] or cell_FG > self.df_style.loc[0, 'fg_max']:
-                return 'X'
-            else:
-                return ''
-        cell_IBU_style_check = cell(8, 3, background_color='red')
-        @calculation(inputs=[cell_IBU], output=cell_IBU_style_check)
-        def IBU_check(cell_IBU):
-            if cell_IBU < self.df_style.loc[0, 'ibu_min'] or cell_IBU > self.df_style.loc[0, 'ibu_max']:
-                return 'X'
-            else:
-                return ''
-        cell_color_style_check = cell(9, 3, background_color='red')
-        @calculation(inputs=[cell_color], output=cell_color_style_check)
-        def color_check(cell_color):
-            if cell_color < self.df_style.loc[0, 'color_min'] or cell_color > self.df_style.loc[0, 'color_max']:
-                return 'X'
-            else:
-                return ''
-        cell_ABV_style_check = cell(11, 3, background_color='red')
-        @calculation(inputs=[cell_ABV], output=cell_ABV_style_check)
-        def ABV_check(cell_ABV):
-            if cell_ABV < self.df_style.loc[0, 'abv_min'] or cell_ABV > self.df_style.loc[0, 'abv_max']:
+        # add checks for style, row 10 (efficiency) is left blank
+        column(3, [None] * 6, row_start=6, type='text', background_color='red')
+
+        def style_check(value, key):
+            if value < self.df_style.loc[0, key + '_min'] or value > self.df_style.loc[0, key + '_max']:
                 return 'X'
             else:
                 return ''
 
-        # add summary calculations
-        @calculation(inputs=[cell_OG, cell_FG], output=cell_ABV)
-        def cell_ABV_calc(OG, FG):
-        	return self.calc_ABV(OG, FG)
-
-        @calculation(inputs=cell_ferms + [cell_mash_efficiency, cell_target_volume], output=cell_OG)
-        def cell_calc_OG(*args):
-            cell_mash_efficiency = args[-2]
-            cell_target_volume = args[-1]
-            OG = self.calc_OG(grain_amounts=args[:-2],
-                              mash_efficiency=cell_mash_efficiency,
-                              target_volume=cell_target_volume)
-            return OG
-
-        @calculation(inputs=[cell_yeast_atten, cell_mash_temp], output=cell_yeast_atten_adj)
-        def calc_adj_atten(cell_yeast_atten, cell_mash_temp):
-            yeast_atten_adj = self.calc_AA(yeast_atten=cell_yeast_atten,
-                                           mash_temp=cell_mash_temp)
-            return yeast_atten_adj
-
-        @calculation(inputs=cell_ferms + [cell_yeast_atten, cell_mash_efficiency, cell_target_volume, cell_mash_temp, cell_OG], output=cell_FG)
-        def cell_calc_FG(*args):
-            cell_yeast_atten = args[-5]
-            cell_mash_efficiency = args[-4]
-            cell_target_volume = args[-3]
-            cell_mash_temp = args[-2]
-            cell_OG = args[-1]
-            FG = self.calc_FG(OG=cell_OG, yeast_atten=cell_yeast_atten,
-                              mash_temp=cell_mash_temp,
-                              grain_amounts=args[:-5],
-                              mash_efficiency=cell_mash_efficiency,
-                              target_volume=cell_target_volume)
-            return FG
-
-        @calculation(inputs=cell_ams + cell_times + cell_ferms + [cell_mash_efficiency, cell_boil_volume, cell_target_volume], output=cell_IBU)
-        def cell_calc_IBU(*args):
-            cell_mash_efficiency = args[-3]
-            cell_boil_volume = args[-2]
-            cell_target_volume = args[-1]
-            IBU = self.calc_IBU(hop_times=args[len(self.hop_bill):2 * len(self.hop_bill)],
-                                hop_amounts=args[:len(self.hop_bill)],
-                                grain_amounts=args[2 * len(self.hop_bill):-3],
-                                mash_efficiency=cell_mash_efficiency,
-                                boil_volume=cell_boil_volume,
-                                target_volume=cell_target_volume)
-            return IBU
-
-        @calculation(inputs=cell_ferms + [cell_target_volume], output=cell_color)
-        def cell_calc_color(*args):
-            cell_target_volume = args[-1]
-            SRM = self.calc_color(grain_amounts=args[:-1],
-                                  target_volume=cell_target_volume)
-            return SRM
+        self.sheet_timings = deque(maxlen=100)
+
+        def update_sheet(change=None):
+            """
+            recompute every output for an edit once, then send
+            them to the front end if any changed
+            """
+            start = time.perf_counter()
+            grain_amounts = [c.value for c in cell_ferms]
+            hop_amounts = [c.value for c in cell_ams]
+            hop_times = [c.value for c in cell_times]
+            mash_efficiency = cell_mash_efficiency.value
+            target_volume = cell_target_volume.value
+            boil_volume = cell_boil_volume.value
+            boil_time = cell_boil_time.value
+            mash_temp = cell_mash_temp.value
+            yeast_atten = cell_yeast_atten.value
+
+            OG = self.calc_OG(grain_amounts=grain_amounts,
+                              mash_efficiency=mash_efficiency,
+                              target_volume=target_volume)
+            FG = self.calc_FG(OG=OG, yeast_atten=yeast_atten,
+                              mash_temp=mash_temp,
+                              grain_amounts=grain_amounts,
+                              mash_efficiency=mash_efficiency,
+                              target_volume=target_volume)
+            ABV = self.calc_ABV(OG, FG)
+            color = self.calc_color(grain_amounts=grain_amounts,
+                                    target_volume=target_volume)
+            BG = self.calc_BG(grain_amounts=grain_amounts,
+                              mash_efficiency=mash_efficiency,
+                              boil_volume=boil_volume)
+            # same as calc_IBU, but keeping the IBU of each hop
+            hop_IBU = [self.est_hop_IBU(BG, hop_times[i], hop_amounts[i],
+                                        hop_alpha[i], target_volume)
+                       for i in range(len(self.hop_bill))]
+            IBU = round(sum(hop_IBU), 1)
+            MG = self.calc_mash_grav(grain_amounts=grain_amounts,
+                                     mash_efficiency=mash_efficiency,
+                                     mash_volume=cell_mash_volume.value)
+            PB_volume = self.calc_PB_volume(boil_volume=boil_volume,
+                                            boil_time=boil_time)
+            PB = self.calc_PB_grav(BG=BG, boil_volume=boil_volume,
+                                   boil_time=boil_time)
+            OG_GU = [int(round(self.calc_GU(grain_amounts[i], grain_yield[i],
+                                            mash_efficiency,
+                                            self.grain_bill[i][2]) / target_volume, 0))
+                     for i in range(len(self.grain_bill))]
+
+            # (row, column, values down from there) of each output
+            outputs = [(6, 1, [OG, FG, IBU, color]),
+                       (11, 1, [ABV]),
+                       (6, 3, [style_check(OG, 'og'), style_check(FG, 'fg'),
+                               style_check(IBU, 'ibu'), style_check(color, 'color'),
+                               '', style_check(ABV, 'abv')]),
+                       (2, 17, [self.calc_AA(yeast_atten=yeast_atten,
+                                             mash_temp=mash_temp)]),
+                       (17, 1, [MG, BG, PB_volume, PB]),
+                       (2, 8, OG_GU),
+                       (2, 13, [round(x, 1) for x in hop_IBU])]
+            value = [[None] * 17 for _ in range(out_rows)]
+            for row, col, values in outputs:
+                for i, x in enumerate(values):
+                    value[row - 2 + i][col - 1] = x
+            computed = time.perf_counter()
+
+            # the outputs are a single widget, so setting its value
+            # sends one message. Nothing is sent if none changed
+            if cell_outputs.value != value:
+                cell_outputs.value = value
+            self.sheet_timings.append({'compute': computed - start,
+                                       'send': time.perf_counter() - computed,
+                                       'total': time.perf_counter() - start})
+
+        for c in (cell_ferms + cell_ams + cell_times +
+                  [cell_yeast_atten, cell_target_volume, cell_boil_volume,
+                   cell_boil_time, cell_mash_temp, cell_mash_efficiency,
+                   cell_mash_volume]):
+            c.observe(update_sheet, 'value')
+        update_sheet()
 
         return sheet1
 
-    def update_recipe_from_sheet(self, sheet1, name):
+    def update_recipe_from_sheet(self, sheet1, name, history=None):
         """
         update your recipe based on what was changed in interactive sheet
 
@@ -886,10 +1404,16 @@ class BrewBuild(object):
 
         name: str
             name of the file to store updated recipe in
+
+        history: RecipeHistory
+            if given, the updated recipe is added to it as a new version
         """
 
         # go through all cells to update values
         for c in sheet1.cells:
+            # the outputs are a range of cells, only inputs are read
+            if c.row_start != c.row_end or c.column_start != c.column_end:
+                continue
             # add in changes in summary table
             if c.row_start == 2 and c.column_start == 1:
                 self.target_volume = c.value
@@ -918,28 +1442,16 @@ class BrewBuild(object):
             if c.row_start == 2 and c.column_start == 16:
                 self.df_yeast.loc[0, 'attenuation'] = c.value
 
-        # update dataframes with new info
-
-        # create dataframes for each bill
-        # doing this will let me change them then
-        # before building the recipe
-        sql_query = "SELECT * FROM fermentable as f WHERE f.id = "
-        for i in range(len(self.grain_bill)):
-            sql_query += str(self.grain_bill[i][0])
-            if i + 1 < len(self.grain_bill):
-                sql_query += " or f.id = "
-        self.df_grain_bill = pd.read_sql_query(sql_query, self.con)
-
-        sql_query = "SELECT * FROM hop as h WHERE h.id = "
-        for i in range(len(self.hop_bill)):
-            sql_query += str(self.hop_bill[i][0])
-            if i + 1 < len(self.hop_bill):
-                sql_query += " or h.id = "
-        self.df_hop_bill = pd.read_sql_query(sql_query, self.con)
+        # update dataframes with new info, this also makes
+        # sure the cached metrics are recomputed
+        self.refresh_ingredients()
 
         # now build the recipe again
         self.build_recipe(name)
 
+        if history is not None:
+            history.commit(self, message=name)
+
     def pickle_build(self, name):
         """
         pickle your build so you can open it later
@@ -961,6 +1473,51 @@ class BrewBuild(object):
             pickle.dump(build, f)
 
 
+def load_tables(con):
+    """
+    load the fermentable, hop, yeast and style tables indexed by id,
+    to pass as tables to BrewBuild when building many recipes. Also
+    holds 'rows', each table with id as a column, and 'positions', an
+    array of the row of each id in it (-1 where there is none), so
+    BrewBuild can slice out its ingredients without an index lookup
+
+    Parameters
+    ----------
+
+    con: sqlite3 connection
+        connection to the sqlite database
+    """
+    tables = {'rows': {}, 'positions': {}}
+    for table in ['fermentable', 'hop', 'yeast', 'style']:
+        df = pd.read_sql_query("SELECT * FROM %s" % table, con)
+        tables[table] = df.set_index('id')
+        ids = df['id'].to_numpy()
+        positions = np.full(ids.max() + 1 if len(ids) > 0 else 0, -1)
+        positions[ids] = np.arange(len(ids))
+        # text columns as plain objects, and copied so the columns of
+        # each dtype are one block, which makes slicing rows cheap
+        tables['rows'][table] = df.astype({c: object for c in df.select_dtypes(exclude='number').columns}).copy()
+        tables['positions'][table] = positions
+    return tables
+
+
+def _table_rows(tables, table, ids):
+    """
+    the rows of a table from load_tables for some ids, as a frame
+    with id as a column like a query on the database gives
+    """
+    if 'positions' not in tables:
+        return tables[table].loc[ids].reset_index()
+    ids = np.asarray(ids, dtype=int)
+    positions = tables['positions'][table]
+    pos = np.where((ids >= 0) & (ids < len(positions)), positions[np.clip(ids, 0, len(positions) - 1)], -1)
+    if (pos < 0).any():
+        raise KeyError("%s ids %s not in table" % (table, list(ids[pos < 0])))
+    rows = tables['rows'][table].take(pos)
+    rows.index = pd.RangeIndex(len(pos))
+    return rows
+
+
 def build_from_pickle(name, con):
     """
     build a BrewBuild object from a past session that
@@ -983,3 +1540,2673 @@ def build_from_pickle(name, con):
                      build['boil_volume'], build['mash_temp'], con, boil_time=build['boil_time'],
                      mash_efficiency=build['mash_efficiency'], style=build['style'], mash_volume=build['mash_volume'])
     return brew
+
+
+def load_mash_schedules(con, mash_ids=None, include_sparge=False):
+    """
+    load mash schedules from the mash and mashstep tables as padded
+    arrays that can be passed straight to calc_step_mash. Values are
+    converted from the database units (C, L) to F and gallons
+
+    Parameters
+    ----------
+
+    con: sqlite3 connection
+        connection to the sqlite database
+
+    mash_ids: list
+        ids of the mashes to load. If None, every mash that
+        has steps is loaded
+
+    include_sparge: bool
+        if True, sparge steps are kept in the schedule. These
+        are dropped by default as sparge water does not go
+        into the mash
+
+    Output
+    ------
+
+    schedules: dict
+        'mash_id' (S,), 'grain_temp' (S,) and the step arrays
+        'step_temp', 'step_time' and 'infuse_volume' of size (S, K),
+        where K is the most steps in any mash. Missing steps are
+        padded with a temp of NaN and a time and volume of 0
+    """
+    sql_query = "SELECT ms.mash_id, ms.name, ms.mstype, ms.step_temp, "
+    sql_query += "ms.step_time, ms.infuse_amount, m.grain_temp "
+    sql_query += "FROM mashstep as ms JOIN mash as m ON m.id = ms.mash_id "
+    sql_query += "WHERE ms.deleted = 0"
+    if mash_ids is not None:
+        sql_query += " AND ms.mash_id IN (%s)" % ",".join(str(int(i)) for i in mash_ids)
+    sql_query += " ORDER BY ms.mash_id, ms.step_number"
+    df = pd.read_sql_query(sql_query, con)
+
+    if not include_sparge:
+        sparge = (df['mstype'].str.contains('Sparge', case=False) |
+                  df['name'].str.contains('Sparge', case=False))
+        df = df[~sparge]
+
+    if mash_ids is None:
+        mash_ids = df['mash_id'].unique()
+    mash_ids = np.asarray(mash_ids, dtype=int)
+
+    # position of each step within its mash
+    row = np.searchsorted(mash_ids, df['mash_id'].to_numpy(),
+                          sorter=np.argsort(mash_ids))
+    row = np.argsort(mash_ids)[row]
+    col = df.groupby('mash_id').cumcount().to_numpy()
+    n_steps = col.max() + 1 if len(col) > 0 else 0
+
+    step_temp = np.full((len(mash_ids), n_steps), np.nan)
+    step_time = np.zeros((len(mash_ids), n_steps))
+    infuse_volume = np.zeros((len(mash_ids), n_steps))
+    step_temp[row, col] = df['step_temp'].to_numpy() * 9 / 5 + 32
+    step_time[row, col] = df['step_time'].to_numpy()
+    infuse_volume[row, col] = df['infuse_amount'].to_numpy() / L_PER_GAL
+
+    grain_temp = np.full(len(mash_ids), 68.)
+    grain_temp[row] = df['grain_temp'].to_numpy() * 9 / 5 + 32
+
+    return {'mash_id': mash_ids, 'grain_temp': grain_temp,
+            'step_temp': step_temp, 'step_time': step_time,
+            'infuse_volume': infuse_volume}
+
+
+def calc_step_mash(step_temps, step_times, infuse_volumes, grain_weight,
+                   mash_GU=None, grain_temp=68., infuse_temp=None):
+    """
+    calculate infusion temperatures/volumes, the step-weighted
+    mash temperature and the resulting mash gravity for multi-step
+    mash schedules. All inputs are numpy arrays that broadcast
+    against each other, where the last axis of the step arrays is the
+    step number. So to compare S schedules across G grain bills, pass
+    the (S, K) step arrays as step_temps[:, None, :] and the (G,)
+    grain arrays as is to get (S, G) outputs
+
+    Parameters
+    ----------
+
+    step_temps: np.array
+        rest temperature of each step in F (NaN for padded steps)
+
+    step_times: np.array
+        length of each step in min
+
+    infuse_volumes: np.array
+        gallons of water added at each step. 0 for steps that are
+        heated directly instead of by infusion
+
+    grain_weight: np.array
+        lbs of grain in the mash
+
+    mash_GU: np.array
+        total gravity units from the mashed grain (see
+        BrewBuild.calc_GU). optional, needed for the mash gravity
+
+    grain_temp: np.array
+        temperature of the grain before the strike in F
+
+    infuse_temp: float
+        temperature of the water used for each infusion after
+        the strike in F. If given, the volumes of these
+        infusions are solved for, otherwise infuse_volumes is used
+
+    Output
+    ------
+
+    mash: dict
+        'infuse_temps' and 'infuse_volumes' per step, the total
+        'water_volume' in the mash, the time weighted conversion
+        'mash_temp' (the last rest temp if no rest between 140 and
+        162 F has a nonzero time, NaN with no rests) and the mash gravity 'MG' (if
+        mash_GU given)
+    """
+    step_temps = np.asarray(step_temps, dtype=float)
+    step_times = np.asarray(step_times, dtype=float)
+    infuse_volumes = np.asarray(infuse_volumes, dtype=float)
+    grain_weight = np.asarray(grain_weight, dtype=float)
+
+    shape = np.broadcast_shapes(step_temps.shape, step_times.shape,
+                                infuse_volumes.shape,
+                                grain_weight.shape + (1,),
+                                np.shape(grain_temp) + (1,))
+    step_temps = np.broadcast_to(step_temps, shape)
+    infuse_volumes = np.broadcast_to(infuse_volumes, shape)
+    # thermal mass of grain in gallons of water, from the
+    # 0.2 specific heat in
+    # http://howtobrew.com/book/section-3/the-methods-of-mashing/calculations-for-boiling-water-additions
+    grain_mass = 0.05 * grain_weight
+
+    temps_out = np.full(shape, np.nan)
+    volumes_out = np.zeros(shape)
+    water = np.zeros(shape[:-1])
+    mash_temp = np.broadcast_to(grain_temp, shape[:-1]).astype(float)
+    for k in range(shape[-1]):
+        temp = step_temps[..., k]
+        valid = ~np.isnan(temp)
+        rise = np.where(valid, temp - mash_temp, 0.)
+        volume = infuse_volumes[..., k]
+        if infuse_temp is not None and k > 0:
+            # solve for infusion to get from last rest to this one
+            volume = np.where(volume > 0,
+                              rise * (grain_mass + water) / (infuse_temp - temp),
+                              0.)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            temps_out[..., k] = np.where(valid & (volume > 0),
+                                         temp + rise * (grain_mass + water) / volume,
+                                         np.nan)
+        volumes_out[..., k] = np.where(valid, volume, 0.)
+        water = water + volumes_out[..., k]
+        mash_temp = np.where(valid, temp, mash_temp)
+
+    # weight each rest by its length, only counting rests
+    # in the range where the amylase enzymes are active
+    weights = np.where((step_temps >= 140) & (step_temps <= 162),
+                       step_times, 0.)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        eff_temp = (np.nansum(step_temps * weights, axis=-1) /
+                    weights.sum(axis=-1))
+    # with no timed conversion rest, fall back to the last rest
+    last_rest = np.where(np.isnan(step_temps).all(axis=-1), np.nan, mash_temp)
+    eff_temp = np.where(np.isnan(eff_temp), last_rest, eff_temp)[()]
+
+    mash = {'infuse_temps': temps_out, 'infuse_volumes': volumes_out,
+            'water_volume': water, 'mash_temp': eff_temp}
+    if mash_GU is not None:
+        # post mash volume adjustment based on loss of 0.125 gal / lb,
+        # same as BrewBuild.calc_mash_grav
+        MG_GU = np.asarray(mash_GU) / (water - 0.125 * grain_weight)
+        mash['MG'] = np.round(MG_GU / 1000 + 1, 3)
+    return mash
+
+
+def _root_ids(con, table, ids):
+    """
+    map ingredient ids to the id of their parent in the <table>_children
+    table. Brewtarget stores a child copy of an ingredient for each
+    recipe that uses it
+    """
+    df = pd.read_sql_query("SELECT parent_id, child_id FROM %s_children" % table, con)
+    parents = pd.Series(df['parent_id'].to_numpy(), index=df['child_id'].to_numpy())
+    ids = pd.Series(np.asarray(ids))
+    return ids.map(parents).fillna(ids).astype(int).to_numpy()
+
+
+def load_recipe_table(con, recipe_ids=None, resolve_parents=True):
+    """
+    load the stored recipes (and their fermentables, hops and yeast)
+    from the recipe tables, converted to the units used by BrewBuild
+
+    Parameters
+    ----------
+
+    con: sqlite3 connection
+        connection to the sqlite database
+
+    recipe_ids: list
+        ids of recipes to load. If None, all recipes that are
+        not deleted are loaded
+
+    resolve_parents: bool
+        if True, ingredient ids are mapped to the parent ingredient
+        rather than the recipe's own copy of it
+
+    Output
+    ------
+
+    tables: dict of pandas.DataFrame
+        'recipes' (id, name, batch_size and boil_size in gal,
+        boil_time, efficiency, style_id, mash_id),
+        'fermentables' (recipe_id, id, amount in lbs, type where
+        mash is 0 and extract is 1), 'hops' (recipe_id, id,
+        amount in oz, time) and 'yeast' (recipe_id, id)
+    """
+    where = "deleted = 0"
+    if recipe_ids is not None:
+        where += " AND id IN (%s)" % ",".join(str(int(i)) for i in recipe_ids)
+    recipes = pd.read_sql_query("SELECT id, name, batch_size, boil_size, boil_time, "
+                                "efficiency, style_id, mash_id FROM recipe "
+                                "WHERE " + where + " ORDER BY id", con)
+    recipes['batch_size'] /= L_PER_GAL
+    recipes['boil_size'] /= L_PER_GAL
+
+    ids = ",".join(str(i) for i in recipes['id'])
+    ferms = pd.read_sql_query("SELECT r.recipe_id, f.id, f.amount, f.ftype "
+                              "FROM fermentable_in_recipe as r JOIN fermentable as f "
+                              "ON f.id = r.fermentable_id "
+                              "WHERE r.recipe_id IN (%s) ORDER BY r.id" % ids, con)
+    ferms['amount'] *= LB_PER_KG
+    # grains and adjuncts get mashed, everything else goes in as extract
+    ferms['type'] = (~ferms['ftype'].isin(['Grain', 'Adjunct'])).astype(int)
+    ferms = ferms.drop(columns='ftype')
+
+    hops = pd.read_sql_query("SELECT r.recipe_id, h.id, h.amount, h.time "
+                             "FROM hop_in_recipe as r JOIN hop as h "
+                             "ON h.id = r.hop_id "
+                             "WHERE r.recipe_id IN (%s) ORDER BY r.id" % ids, con)
+    hops['amount'] *= OZ_PER_KG
+
+    yeast = pd.read_sql_query("SELECT r.recipe_id, r.yeast_id as id "
+                              "FROM yeast_in_recipe as r "
+                              "WHERE r.recipe_id IN (%s) ORDER BY r.id" % ids, con)
+
+    if resolve_parents:
+        ferms['id'] = _root_ids(con, 'fermentable', ferms['id'])
+        hops['id'] = _root_ids(con, 'hop', hops['id'])
+        yeast['id'] = _root_ids(con, 'yeast', yeast['id'])
+
+    return {'recipes': recipes, 'fermentables': ferms,
+            'hops': hops, 'yeast': yeast}
+
+
+def load_inventory(con):
+    """
+    load what is in stock from the inventory tables
+
+    Parameters
+    ----------
+
+    con: sqlite3 connection
+        connection to the sqlite database
+
+    Output
+    ------
+
+    df: pandas.DataFrame
+        one row per ingredient with kind ('fermentable', 'hop' or
+        'yeast'), id, name and amount in stock (lbs, oz or packages)
+    """
+    sql_query = "SELECT 'fermentable' as kind, f.id, f.name, i.amount * %f as amount "
+    sql_query += "FROM fermentable as f JOIN fermentable_in_inventory as i "
+    sql_query += "ON i.id = f.inventory_id WHERE f.deleted = 0 "
+    sql_query += "UNION ALL "
+    sql_query += "SELECT 'hop', h.id, h.name, i.amount * %f "
+    sql_query += "FROM hop as h JOIN hop_in_inventory as i "
+    sql_query += "ON i.id = h.inventory_id WHERE h.deleted = 0 "
+    sql_query += "UNION ALL "
+    sql_query += "SELECT 'yeast', y.id, y.name, i.quanta "
+    sql_query += "FROM yeast as y JOIN yeast_in_inventory as i "
+    sql_query += "ON i.id = y.inventory_id WHERE y.deleted = 0"
+    return pd.read_sql_query(sql_query % (LB_PER_KG, OZ_PER_KG), con)
+
+
+def plan_batches(con, brews=None, recipe_ids=None, inventory=None,
+                 optimize=False):
+    """
+    work out which recipes can be brewed from what is in stock, how
+    many batches of each would fit and what is missing for each
+
+    Parameters
+    ----------
+
+    con: sqlite3 connection
+        connection to the sqlite database
+
+    brews: list
+        list of BrewBuild objects to plan. If None, the stored
+        recipes in the recipe table are used
+
+    recipe_ids: list
+        ids of stored recipes to plan if brews is None. If None,
+        all stored recipes are used
+
+    inventory: pandas.DataFrame
+        stock to plan against, in the format of load_inventory.
+        If None, the inventory tables in the database are used
+
+    optimize: bool
+        if True, also pick the number of batches of each recipe
+        that gives the most total volume with the stock on hand
+
+    Output
+    ------
+
+    plan: pandas.DataFrame
+        one row per recipe with name, volume (gal), max_batches
+        (batches that fit if only this recipe is brewed), brewable
+        and, if optimize, batches in the best mix
+
+    shortfall: pandas.DataFrame
+        what is missing to brew one batch of each recipe, one row
+        per recipe and ingredient that is short, with columns
+        recipe, kind, id, name, needed, in_stock and short
+    """
+    # one row per (recipe, ingredient) in long format
+    if brews is not None:
+        req = []
+        for i, brew in enumerate(brews):
+            req.append(pd.DataFrame({'row': i, 'kind': 'fermentable',
+                                     'id': brew.grain_bill[:, 0].astype(int),
+                                     'amount': brew.grain_bill[:, 1]}))
+            req.append(pd.DataFrame({'row': i, 'kind': 'hop',
+                                     'id': brew.hop_bill[:, 0].astype(int),
+                                     'amount': brew.hop_bill[:, 1]}))
+            req.append(pd.DataFrame({'row': [i], 'kind': 'yeast',
+                                     'id': [int(brew.yeast)], 'amount': [1.]}))
+        req = pd.concat(req, ignore_index=True)
+        plan = pd.DataFrame({'name': ['brew_%d' % i for i in range(len(brews))],
+                             'volume': [brew.target_volume for brew in brews]})
+    else:
+        tables = load_recipe_table(con, recipe_ids=recipe_ids)
+        recipes = tables['recipes']
+        plan = pd.DataFrame({'name': recipes['name'].to_numpy(),
+                             'volume': recipes['batch_size'].to_numpy()},
+                            index=recipes['id'].to_numpy())
+        row = pd.Series(np.arange(len(recipes)), index=recipes['id'].to_numpy())
+        req = []
+        for kind, table in [('fermentable', 'fermentables'), ('hop', 'hops'), ('yeast', 'yeast')]:
+            df = tables[table]
+            amount = df['amount'] if kind != 'yeast' else 1.
+            req.append(pd.DataFrame({'row': row[df['recipe_id']].to_numpy(), 'kind': kind,
+                                     'id': df['id'].to_numpy(), 'amount': amount}))
+        req = pd.concat(req, ignore_index=True)
+
+    if inventory is None:
+        inventory = load_inventory(con)
+
+    # columns of the requirement matrix are every ingredient in
+    # stock or asked for by a recipe
+    keys = pd.concat([inventory[['kind', 'id']], req[['kind', 'id']]])
+    keys = keys.drop_duplicates().reset_index(drop=True)
+    key_index = pd.MultiIndex.from_frame(keys)
+    inv_col = key_index.get_indexer(pd.MultiIndex.from_frame(inventory[['kind', 'id']]))
+    req_col = key_index.get_indexer(pd.MultiIndex.from_frame(req[['kind', 'id']]))
+
+    stock = np.zeros(len(keys))
+    np.add.at(stock, inv_col, inventory['amount'].to_numpy(dtype=float))
+
+    R = sparse.csr_matrix((req['amount'].to_numpy(dtype=float),
+                           (req['row'].to_numpy(), req_col)),
+                          shape=(len(plan), len(keys)))
+    R.sum_duplicates()
+    R.eliminate_zeros()
+
+    # batches that fit are limited by the scarcest ingredient, so
+    # take the min of stock / need along each row of the matrix
+    ratio = stock[R.indices] / R.data
+    has_rows = np.diff(R.indptr) > 0
+    fits = np.zeros(len(plan))
+    fits[has_rows] = np.minimum.reduceat(ratio, R.indptr[:-1][has_rows])
+    plan['max_batches'] = np.floor(fits).astype(int)
+    plan['brewable'] = plan['max_batches'] >= 1
+
+    # shortfall for a single batch, only kept where it is non-zero
+    need = R.tocoo()
+    short = np.maximum(need.data - stock[need.col], 0)
+    is_short = short > 0
+    rows, cols = need.row[is_short], need.col[is_short]
+    names = inventory.drop_duplicates(['kind', 'id']).set_index(['kind', 'id'])['name']
+    shortfall = pd.DataFrame({'recipe': plan.index[rows],
+                              'kind': keys['kind'].to_numpy()[cols],
+                              'id': keys['id'].to_numpy()[cols]})
+    # what is not in stock at all has no inventory name, so
+    # look it up in the ingredient tables
+    missing = shortfall[~pd.MultiIndex.from_frame(shortfall[['kind', 'id']]).isin(names.index)]
+    for kind in missing['kind'].unique():
+        ids = ",".join(str(int(i)) for i in missing['id'][missing['kind'] == kind].unique())
+        df = pd.read_sql_query("SELECT id, name FROM %s WHERE id IN (%s)" % (kind, ids), con)
+        names = pd.concat([names, pd.Series(df['name'].to_numpy(),
+                                            index=pd.MultiIndex.from_arrays([[kind] * len(df), df['id']]))])
+    shortfall['name'] = names.reindex(pd.MultiIndex.from_frame(shortfall[['kind', 'id']])).to_numpy()
+    shortfall['needed'] = need.data[is_short]
+    shortfall['in_stock'] = stock[cols]
+    shortfall['short'] = short[is_short]
+
+    if optimize:
+        # integer program: maximize total volume with the total
+        # need for each ingredient no more than what is in stock
+        res = milp(c=-plan['volume'].to_numpy(dtype=float),
+                   constraints=LinearConstraint(R.T.tocsr(), -np.inf, stock),
+                   integrality=np.ones(len(plan)),
+                   bounds=Bounds(0, np.where(has_rows, plan['max_batches'], 0)))
+        plan['batches'] = np.round(res.x).astype(int) if res.x is not None else 0
+
+    return plan, shortfall
+
+
+def _segment_sum(values, offsets):
+    """
+    sum values over the segments values[offsets[i]:offsets[i + 1]],
+    giving 0 for empty segments (np.add.reduceat does not)
+    """
+    counts = np.diff(offsets)
+    sums = np.zeros(len(counts))
+    nonempty = counts > 0
+    if len(values) > 0:
+        sums[nonempty] = np.add.reduceat(values, offsets[:-1][nonempty])
+    return sums
+
+
+def _load_catalog(con):
+    """
+    load the ingredient properties needed for recipe calculations
+    as dense arrays indexed by ingredient id
+    """
+    catalog = {}
+    for table, columns in [('fermentable', ['yield', 'color']),
+                           ('hop', ['alpha']),
+                           ('yeast', ['attenuation'])]:
+        df = pd.read_sql_query("SELECT id, %s FROM %s" % (", ".join('"%s"' % c for c in columns), table), con)
+        ids = df['id'].to_numpy()
+        for c in columns:
+            arr = np.full(ids.max() + 1 if len(ids) > 0 else 0, np.nan)
+            arr[ids] = df[c].to_numpy(dtype=float)
+            catalog[table + '_' + c] = arr
+    return catalog
+
+
+def _catalog_values(catalog, key, ids):
+    """
+    look up ingredient properties in a catalog from _load_catalog.
+    Ids that are missing (e.g. -1 for no yeast) or not in the
+    catalog give NaN rather than wrapping around the array
+    """
+    values = catalog[key]
+    ids = np.asarray(ids)
+    found = (ids >= 0) & (ids < len(values))
+    return np.where(found, values[np.where(found, ids, 0)], np.nan)
+
+
+class RecipeBatch(object):
+    """
+    many recipes stored as flat arrays (structure of arrays) so a
+    whole library can be held in memory and evaluated at once. The
+    grain and hop rows of every recipe are stacked, and recipe i owns
+    rows offsets[i]:offsets[i + 1] (like a CSR sparse matrix)
+
+    Parameters
+    ----------
+
+    grain_offsets: np.array
+        array of size (R + 1,) with the start of each recipe's rows
+        in the grain arrays
+
+    grain_ids: np.array
+        id in the fermentable table for each grain row
+
+    grain_amounts: np.array
+        amount in lbs for each grain row
+
+    grain_types: np.array
+        mash (0) or extract (1) for each grain row
+
+    hop_offsets: np.array
+        array of size (R + 1,) with the start of each recipe's rows
+        in the hop arrays
+
+    hop_ids: np.array
+        id in the hop table for each hop row
+
+    hop_amounts: np.array
+        amount in oz for each hop row
+
+    hop_times: np.array
+        boil time in min for each hop row
+
+    yeast: np.array
+        id of the yeast for each recipe, -1 if there is none
+        (FG and ABV are then NaN)
+
+    target_volume: np.array
+        target volume of each recipe in gallons
+
+    boil_volume: np.array
+        volume of wort pre-boil in gallons
+
+    mash_temp: np.array
+        temperature of the mash in F
+
+    con: sqlite3 connection
+        connection to sqlite database, used to look up
+        ingredient properties
+
+    boil_time: np.array
+        length of boil (in min)
+
+    mash_efficiency: np.array
+        mash efficiency as a percentage
+
+    style: np.array
+        style id of each recipe, -1 if there is none
+
+    mash_volume: np.array
+        volume of water in mash in gallons
+
+    yeast_atten: np.array
+        attenuation (%) of each recipe's yeast, NaN to use the
+        value from the yeast table (e.g. when it has not been
+        edited in the interactive sheet)
+
+    NOTE: the per-recipe values can also be given as scalars,
+          in which case they are used for every recipe
+
+    Methods
+    -------
+
+    from_brews(brews, con):
+        build a RecipeBatch from a list of BrewBuild objects
+
+    from_recipe_table(con, recipe_ids):
+        build a RecipeBatch from the stored recipes in the database
+
+    calc_metrics():
+        calculate OG, FG, ABV, IBU, color and BG of every recipe
+
+    calc_water(water, salts):
+        calculate residual alkalinity and mash pH of every
+        recipe with one or more water profiles
+
+    correct_brew_day(measured_MG, measured_BG, measured_volume):
+        solve the actual mash efficiency from brew day measurements
+        and the corrections needed to hit the target OG and volume
+
+    to_brew(i):
+        create a BrewBuild object for recipe i
+
+    to_brews():
+        lazily create BrewBuild objects for every recipe
+    """
+
+    def __init__(self, grain_offsets, grain_ids, grain_amounts, grain_types,
+                 hop_offsets, hop_ids, hop_amounts, hop_times, yeast,
+                 target_volume, boil_volume, mash_temp, con, boil_time=60,
+                 mash_efficiency=70, style=-1, mash_volume=1,
+                 yeast_atten=np.nan):
+        self.grain_offsets = np.asarray(grain_offsets, dtype=np.int64)
+        self.grain_ids = np.asarray(grain_ids, dtype=np.int32)
+        self.grain_amounts = np.asarray(grain_amounts, dtype=np.float64)
+        self.grain_types = np.asarray(grain_types, dtype=np.int8)
+        self.hop_offsets = np.asarray(hop_offsets, dtype=np.int64)
+        self.hop_ids = np.asarray(hop_ids, dtype=np.int32)
+        self.hop_amounts = np.asarray(hop_amounts, dtype=np.float64)
+        self.hop_times = np.asarray(hop_times, dtype=np.float64)
+
+        n = len(self.grain_offsets) - 1
+
+        def per_recipe(value, dtype):
+            return np.ascontiguousarray(np.broadcast_to(np.asarray(value, dtype=dtype), (n,)))
+
+        self.yeast = per_recipe(yeast, np.int32)
+        self.target_volume = per_recipe(target_volume, np.float64)
+        self.boil_volume = per_recipe(boil_volume, np.float64)
+        self.mash_temp = per_recipe(mash_temp, np.float64)
+        self.boil_time = per_recipe(boil_time, np.float64)
+        self.mash_efficiency = per_recipe(mash_efficiency, np.float64)
+        self.style = per_recipe(style, np.int32)
+        self.mash_volume = per_recipe(mash_volume, np.float64)
+        self.yeast_atten = per_recipe(yeast_atten, np.float64)
+        self.con = con
+
+        self.catalog = _load_catalog(con)
+
+    def _attenuation(self):
+        """
+        attenuation of each recipe's yeast, using yeast_atten where given
+        """
+        atten = _catalog_values(self.catalog, 'yeast_attenuation', self.yeast)
+        return np.where(np.isnan(self.yeast_atten), atten, self.yeast_atten)
+
+    def __len__(self):
+        return len(self.grain_offsets) - 1
+
+    @classmethod
+    def from_brews(cls, brews, con=None):
+        """
+        build a RecipeBatch from a list of BrewBuild objects. If
+        con is None, the connection of the first brew is used
+        """
+        brews = list(brews)
+        if con is None:
+            con = brews[0].con
+        grain = [np.asarray(b.grain_bill, dtype=float).reshape(-1, 3) for b in brews]
+        hops = [np.asarray(b.hop_bill, dtype=float).reshape(-1, 3) for b in brews]
+        grain_offsets = np.concatenate([[0], np.cumsum([len(g) for g in grain])])
+        hop_offsets = np.concatenate([[0], np.cumsum([len(h) for h in hops])])
+        grain = np.concatenate(grain) if len(grain) > 0 else np.zeros((0, 3))
+        hops = np.concatenate(hops) if len(hops) > 0 else np.zeros((0, 3))
+        return cls(grain_offsets, grain[:, 0], grain[:, 1], grain[:, 2],
+                   hop_offsets, hops[:, 0], hops[:, 1], hops[:, 2],
+                   [b.yeast for b in brews],
+                   [b.target_volume for b in brews],
+                   [b.boil_volume for b in brews],
+                   [b.mash_temp for b in brews], con,
+                   boil_time=[b.boil_time for b in brews],
+                   mash_efficiency=[b.mash_efficiency for b in brews],
+                   style=[-1 if b.style is None else b.style for b in brews],
+                   mash_volume=[b.mash_volume for b in brews],
+                   yeast_atten=[b.df_yeast.loc[0, 'attenuation'] for b in brews])
+
+    @classmethod
+    def from_recipe_table(cls, con, recipe_ids=None):
+        """
+        build a RecipeBatch from the stored recipes in the database,
+        using each recipe's own copy of its ingredients. The mash temp
+        and volume come from the recipe's mash schedule (see
+        calc_step_mash) when it has one
+        """
+        tables = load_recipe_table(con, recipe_ids=recipe_ids, resolve_parents=False)
+        recipes = tables['recipes']
+        row = pd.Series(np.arange(len(recipes)), index=recipes['id'].to_numpy())
+
+        ferms = tables['fermentables']
+        ferm_row = row[ferms['recipe_id']].to_numpy()
+        order = np.argsort(ferm_row, kind='stable')
+        grain_offsets = np.searchsorted(ferm_row[order], np.arange(len(recipes) + 1))
+        ferms = ferms.iloc[order]
+
+        hops = tables['hops']
+        hop_row = row[hops['recipe_id']].to_numpy()
+        hop_order = np.argsort(hop_row, kind='stable')
+        hop_offsets = np.searchsorted(hop_row[hop_order], np.arange(len(recipes) + 1))
+        hops = hops.iloc[hop_order]
+
+        yeast = tables['yeast'].drop_duplicates('recipe_id').set_index('recipe_id')['id']
+        yeast = yeast.reindex(recipes['id']).fillna(-1).to_numpy()
+
+        mash_temp = np.full(len(recipes), 152.)
+        mash_volume = np.ones(len(recipes))
+        has_mash = recipes['mash_id'].notna().to_numpy()
+        if has_mash.any():
+            schedules = load_mash_schedules(con, recipes['mash_id'][has_mash].unique())
+            if schedules['step_temp'].shape[1] > 0:
+                mash = calc_step_mash(schedules['step_temp'], schedules['step_time'],
+                                      schedules['infuse_volume'], 0.,
+                                      grain_temp=schedules['grain_temp'])
+                found = pd.Series(np.arange(len(schedules['mash_id'])), index=schedules['mash_id'])
+                found = found.reindex(recipes['mash_id'][has_mash]).to_numpy()
+                ok = ~np.isnan(found)
+                idx = np.flatnonzero(has_mash)[ok]
+                mash_temp[idx] = np.nan_to_num(mash['mash_temp'][found[ok].astype(int)], nan=152.)
+                mash_volume[idx] = mash['water_volume'][found[ok].astype(int)]
+
+        return cls(grain_offsets, ferms['id'].to_numpy(), ferms['amount'].to_numpy(),
+                   ferms['type'].to_numpy(), hop_offsets, hops['id'].to_numpy(),
+                   hops['amount'].to_numpy(), hops['time'].to_numpy(), yeast,
+                   recipes['batch_size'].to_numpy(), recipes['boil_size'].to_numpy(),
+                   mash_temp, con, boil_time=recipes['boil_time'].to_numpy(),
+                   mash_efficiency=recipes['efficiency'].to_numpy(),
+                   style=recipes['style_id'].fillna(-1).to_numpy(),
+                   mash_volume=mash_volume)
+
+    def calc_metrics(self):
+        """
+        calculate OG, FG, ABV, IBU, color (SRM) and BG for every
+        recipe, with the same formulas (and rounding) as BrewBuild
+
+        Output
+        ------
+
+        df: pandas.DataFrame
+            one row per recipe with the metrics as columns
+        """
+        grain_counts = np.diff(self.grain_offsets)
+        hop_counts = np.diff(self.hop_offsets)
+
+        # per grain row values, see BrewBuild.calc_GU
+        grain_yield = _catalog_values(self.catalog, 'fermentable_yield', self.grain_ids)
+        grain_color = _catalog_values(self.catalog, 'fermentable_color', self.grain_ids)
+        eff = np.repeat(self.mash_efficiency, grain_counts)
+        points = self.grain_amounts * (grain_yield / 100) * 46
+        GU = np.where(self.grain_types == 0, points * (eff / 100), points)
+
+        total_GU = _segment_sum(GU, self.grain_offsets)
+        OG = np.round(total_GU / self.target_volume / 1000 + 1, 3)
+        BG = np.round(total_GU / self.boil_volume / 1000 + 1, 3)
+
+        # see BrewBuild.calc_AA and BrewBuild.calc_FG
+        atten = self._attenuation()
+        atten_adj = atten - (self.mash_temp - 153.5) * 1.25
+        atten_rows = np.where(self.grain_types == 0,
+                              GU * (np.repeat(atten_adj, grain_counts) / 100),
+                              points * (np.repeat(atten, grain_counts) / 100))
+        FG_GU = (OG - 1) * 1000 - _segment_sum(atten_rows, self.grain_offsets) / self.target_volume
+        FG = np.round(FG_GU / 1000 + 1, 3)
+        ABV = np.round((OG - FG) * 131.25, 2)
+
+        # see BrewBuild.calc_color
+        MCU = _segment_sum(self.grain_amounts * grain_color, self.grain_offsets) / self.target_volume
+        color = np.round(1.4922 * (MCU ** 0.6859), 1)
+
+        # see BrewBuild.est_hop_IBU
+        hop_BG = np.repeat(BG, hop_counts)
+        alpha = _catalog_values(self.catalog, 'hop_alpha', self.hop_ids)
+        fG = 1.65 * 0.000125 ** (hop_BG - 1)
+        fT = (1 - np.exp(-0.04 * self.hop_times)) / 4.15
+        C_grav = 1 + ((hop_BG - 1.050) / 0.2)
+        hop_IBU = (self.hop_amounts * (alpha / 100) * fG * fT * 7489) / (np.repeat(self.target_volume, hop_counts) * C_grav)
+        IBU = np.round(_segment_sum(hop_IBU, self.hop_offsets), 1)
+
+        return pd.DataFrame({'OG': OG, 'FG': FG, 'ABV': ABV, 'IBU': IBU,
+                             'color': color, 'BG': BG})
+
+    def calc_water(self, water, salts=None):
+        """
+        calculate the residual alkalinity and predicted mash pH of
+        every recipe with every water profile, using each recipe's
+        mash volume as the water volume
+
+        Parameters
+        ----------
+
+        water: np.array
+            ion profiles (ppm) in the order of WATER_IONS, of size (P, 6)
+
+        salts: np.array
+            grams per gallon of each salt in WATER_SALTS, of size
+            (P, n_salts) to match the water profiles
+
+        Output
+        ------
+
+        water: dict
+            'profile' (P, 6), 'RA' (P,) and 'pH' of size (P, R)
+        """
+        profile = calc_water_profile(np.atleast_2d(water), salts)
+        RA = calc_residual_alkalinity(profile)
+
+        mashed = self.grain_types == 0
+        amounts = np.where(mashed, self.grain_amounts, 0.)
+        color = _catalog_values(self.catalog, 'fermentable_color', self.grain_ids)
+        acidity = _segment_sum(calc_grain_acidity(amounts[:, None], color[:, None]),
+                               self.grain_offsets)
+        grain_weight = _segment_sum(amounts, self.grain_offsets)
+        pH = calc_mash_pH(RA[:, None], grain_weight, acidity, self.mash_volume)
+        return {'profile': profile, 'RA': RA, 'pH': pH}
+
+    def correct_brew_day(self, measured_MG=np.nan, measured_BG=np.nan,
+                         measured_volume=np.nan, extract_yield=95.,
+                         use_extract=True):
+        """
+        reconcile brew day measurements with every recipe. The actual
+        mash efficiency is solved from the measured pre-boil gravity
+        and volume (or from the post-mash gravity if those are not
+        measured), then the extract addition, top-up water and change
+        in boil time needed to hit the target OG and volume are worked
+        out and OG, FG, ABV and IBU are re-projected. Row i of a brew
+        log is reconciled against recipe i
+
+        Parameters
+        ----------
+
+        measured_MG: np.array
+            measured gravity of the wort after the mash (before any
+            extract is added), NaN if not measured
+
+        measured_BG: np.array
+            measured pre-boil gravity (after any extract is added),
+            NaN if not measured
+
+        measured_volume: np.array
+            measured pre-boil volume in gallons. If NaN, the planned
+            boil volume is used
+
+        extract_yield: float
+            yield (%) of the extract used to make up missing gravity
+            points, 95 for DME and about 78 for LME
+
+        use_extract: bool
+            if True, missing gravity points are made up with extract.
+            If False, the volume is cut to hit the target OG instead (less
+            top-up water or a longer boil), ending short of the target volume
+
+        Output
+        ------
+
+        df: pandas.DataFrame
+            one row per recipe with the planned MG, BG and PB_volume,
+            mash_efficiency (actual, in %), extract_amount (lbs),
+            top_up_volume (gal of water to add after the boil),
+            boil_time_change (extra min of boil), final_volume (gal)
+            and the re-projected OG, FG, ABV and IBU
+        """
+        n = len(self)
+        measured_MG = np.broadcast_to(np.asarray(measured_MG, dtype=float), (n,))
+        measured_BG = np.broadcast_to(np.asarray(measured_BG, dtype=float), (n,))
+        measured_volume = np.broadcast_to(np.asarray(measured_volume, dtype=float), (n,))
+        hop_counts = np.diff(self.hop_offsets)
+
+        # points at 100% efficiency for mashed grain and points from extract,
+        # see BrewBuild.calc_GU
+        grain_yield = _catalog_values(self.catalog, 'fermentable_yield', self.grain_ids)
+        points = self.grain_amounts * (grain_yield / 100) * 46
+        mashed = self.grain_types == 0
+        mash_points = _segment_sum(np.where(mashed, points, 0.), self.grain_offsets)
+        extract_points = _segment_sum(np.where(mashed, 0., points), self.grain_offsets)
+        mash_weight = _segment_sum(np.where(mashed, self.grain_amounts, 0.), self.grain_offsets)
+
+        # planned values, see BrewBuild.calc_mash_grav, calc_BG and calc_PB_volume
+        wort_volume = self.mash_volume - 0.125 * mash_weight
+        with np.errstate(divide='ignore', invalid='ignore'):
+            planned_MG = np.round(mash_points * (self.mash_efficiency / 100) / wort_volume / 1000 + 1, 3)
+        planned_points = mash_points * (self.mash_efficiency / 100) + extract_points
+        planned_BG = np.round(planned_points / self.boil_volume / 1000 + 1, 3)
+        planned_PB_volume = self.boil_volume - 0.75 * self.boil_time / 60
+
+        # actual efficiency: all points in the pre-boil wort come from the
+        # mash (at the unknown efficiency) and the extract, so
+        # (BG - 1) * 1000 * volume = mash_points * eff / 100 + extract_points
+        boil_volume = np.where(np.isnan(measured_volume), self.boil_volume, measured_volume)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            eff_BG = ((measured_BG - 1) * 1000 * boil_volume - extract_points) / mash_points * 100
+            eff_MG = (measured_MG - 1) * 1000 * wort_volume / mash_points * 100
+        eff = np.where(np.isnan(eff_BG), eff_MG, eff_BG)
+        eff = np.where(np.isfinite(eff), eff, self.mash_efficiency)
+        total_points = mash_points * (eff / 100) + extract_points
+        # gravities are read to 0.001, so a miss of less than half a point
+        # over the measured volume is rounding and the plan was hit
+        tolerance = 0.5 * np.where(np.isnan(eff_BG), wort_volume, boil_volume)
+        on_plan = np.abs(total_points - planned_points) < tolerance
+        eff = np.where(on_plan, self.mash_efficiency, eff)
+        total_points = np.where(on_plan, planned_points, total_points)
+
+        # extract makes up any missing points, then the volume is brought
+        # to where the gravity hits the target OG by topping up or boiling
+        target_GU = planned_points / self.target_volume
+        short = np.maximum(planned_points - total_points, 0)
+        if use_extract:
+            extract_amount = short / ((extract_yield / 100) * 46)
+        else:
+            extract_amount = np.zeros(n)
+        final_points = total_points + extract_amount * (extract_yield / 100) * 46
+        with np.errstate(divide='ignore', invalid='ignore'):
+            final_volume = np.where(target_GU > 0, final_points / target_GU, self.target_volume)
+        # a planned post-boil volume above the target volume is taken as
+        # losses (trub, chiller) that never reach the fermenter
+        losses = np.maximum(planned_PB_volume - self.target_volume, 0)
+        PB_volume = boil_volume - 0.75 * self.boil_time / 60 - losses
+        top_up_volume = np.maximum(final_volume - PB_volume, 0)
+        boil_time_change = np.maximum(PB_volume - final_volume, 0) / 0.75 * 60
+
+        # re-project, see RecipeBatch.calc_metrics
+        OG = np.round(final_points / final_volume / 1000 + 1, 3)
+        atten = self._attenuation()
+        atten_adj = atten - (self.mash_temp - 153.5) * 1.25
+        atten_points = (mash_points * (eff / 100) * (atten_adj / 100) +
+                        (final_points - mash_points * (eff / 100)) * (atten / 100))
+        FG = np.round(((OG - 1) * 1000 - atten_points / final_volume) / 1000 + 1, 3)
+        ABV = np.round((OG - FG) * 131.25, 2)
+
+        BG = np.repeat(np.round(final_points / boil_volume / 1000 + 1, 3), hop_counts)
+        alpha = _catalog_values(self.catalog, 'hop_alpha', self.hop_ids)
+        fG = 1.65 * 0.000125 ** (BG - 1)
+        fT = (1 - np.exp(-0.04 * self.hop_times)) / 4.15
+        C_grav = 1 + ((BG - 1.050) / 0.2)
+        hop_IBU = (self.hop_amounts * (alpha / 100) * fG * fT * 7489) / (np.repeat(final_volume, hop_counts) * C_grav)
+        IBU = np.round(_segment_sum(hop_IBU, self.hop_offsets), 1)
+
+        return pd.DataFrame({'planned_MG': planned_MG, 'planned_BG': planned_BG,
+                             'planned_PB_volume': planned_PB_volume,
+                             'mash_efficiency': eff, 'extract_amount': extract_amount,
+                             'top_up_volume': top_up_volume,
+                             'boil_time_change': boil_time_change,
+                             'final_volume': final_volume,
+                             'OG': OG, 'FG': FG, 'ABV': ABV, 'IBU': IBU})
+
+    def to_brew(self, i):
+        """
+        create a BrewBuild object for recipe i
+        """
+        g0, g1 = self.grain_offsets[i], self.grain_offsets[i + 1]
+        h0, h1 = self.hop_offsets[i], self.hop_offsets[i + 1]
+        grain_bill = np.column_stack([self.grain_ids[g0:g1], self.grain_amounts[g0:g1],
+                                      self.grain_types[g0:g1]]).astype(float)
+        hop_bill = np.column_stack([self.hop_ids[h0:h1], self.hop_amounts[h0:h1],
+                                    self.hop_times[h0:h1]]).astype(float)
+        if self.yeast[i] < 0:
+            raise ValueError("recipe %d has no yeast" % i)
+        style = int(self.style[i]) if self.style[i] >= 0 else None
+        brew = BrewBuild(grain_bill, hop_bill, int(self.yeast[i]),
+                         self.target_volume[i], self.boil_volume[i],
+                         self.mash_temp[i], self.con,
+                         boil_time=self.boil_time[i],
+                         mash_efficiency=self.mash_efficiency[i],
+                         style=style, mash_volume=self.mash_volume[i])
+        if not np.isnan(self.yeast_atten[i]):
+            brew.df_yeast.loc[0, 'attenuation'] = self.yeast_atten[i]
+            brew.clear_metric_cache()
+        return brew
+
+    def to_brews(self):
+        """
+        lazily create BrewBuild objects for every recipe
+        """
+        for i in range(len(self)):
+            yield self.to_brew(i)
+
+
+# rows of the summary table in recipe_template.csv and the
+# BrewBuild attribute each one is read back into
+CSV_SUMMARY_ROWS = {'Batch Size': 'target_volume',
+                    'Boil Size': 'boil_volume',
+                    'Boil Time': 'boil_time',
+                    'Mash Temp': 'mash_temp',
+                    'Efficiency': 'mash_efficiency',
+                    'Mash Volume': 'mash_volume'}
+
+# ingredient properties that tell apart database rows with the same
+# name when reading a recipe csv back (the csv has the GU of each
+# fermentable, the OG and color of the beer and the IBU of each hop)
+CSV_MATCH = {'fermentable': ['yield', 'color'],
+             'hop': ['alpha'],
+             'yeast': ['attenuation']}
+
+# style range rows in recipe_template.csv and their style table columns
+CSV_STYLE_ROWS = {'OG': 'og', 'FG': 'fg', 'Bitterness': 'ibu',
+                  'Color': 'color', 'ABV': 'abv'}
+
+
+def parse_recipe_csv(name):
+    """
+    parse a recipe csv written by BrewBuild.build_recipe. The file
+    is read one row at a time and ingredients are left as names
+
+    Parameters
+    ----------
+
+    name: str
+        name of the csv file
+
+    Output
+    ------
+
+    recipe: dict
+        the summary values (keyed by BrewBuild attribute name),
+        'fermentables' as a list of (name, amount, type),
+        'hops' as a list of (name, amount, time), 'yeast' and
+        'yeast_atten', 'style_ranges' keyed by style column and the
+        values written for checking: 'fermentable_GU', 'hop_IBU'
+        (lists in the same order as the bills), 'OG' and 'color'
+    """
+    recipe = {'fermentables': [], 'hops': [], 'style_ranges': {},
+              'fermentable_GU': [], 'hop_IBU': [], 'OG': np.nan, 'color': np.nan}
+    with open(name, 'r', encoding='utf-8-sig', newline='') as f:
+        for i, line in enumerate(csv.reader(f)):
+            # first two rows are the headers
+            if i < 2 or len(line) == 0:
+                continue
+            line = line + [''] * (20 - len(line))
+            if line[0] in CSV_SUMMARY_ROWS and line[1] != '':
+                recipe[CSV_SUMMARY_ROWS[line[0]]] = float(line[1])
+            if line[0] in CSV_STYLE_ROWS and line[2] != '':
+                low, high = line[2].split('-')
+                recipe['style_ranges'][CSV_STYLE_ROWS[line[0]]] = (float(low), float(high))
+            if line[0] in ('OG', 'Color') and line[1] != '':
+                recipe[line[0] if line[0] == 'OG' else 'color'] = float(line[1])
+            if line[5] != '':
+                recipe['fermentables'].append((line[5], float(line[6]),
+                                               0 if line[7] == 'Mash' else 1))
+                recipe['fermentable_GU'].append(float(line[8]) if line[8] != '' else np.nan)
+            if line[10] != '':
+                recipe['hops'].append((line[10], float(line[11]), float(line[12])))
+                recipe['hop_IBU'].append(float(line[13]) if line[13] != '' else np.nan)
+            if line[15] != '':
+                recipe['yeast'] = line[15]
+                recipe['yeast_atten'] = float(line[16])
+    return recipe
+
+
+class RecipeCSVReader(object):
+    """
+    read recipe csvs written by BrewBuild.build_recipe back into
+    BrewBuild objects. The name to id lookups for each ingredient
+    table are loaded once up front, so reading many files does not
+    query the database per ingredient. Where the database has rows
+    with the same name and different properties, the row is picked
+    by checking the GU, OG, color and IBU written in the csv (falling
+    back to the catalog entry where they all match), and a ValueError
+    is raised if that still does not leave exactly one
+
+    Parameters
+    ----------
+
+    con: sqlite3 connection
+        connection to sqlite database
+
+    Methods
+    -------
+
+    resolve(recipe):
+        turn the names in a parsed recipe into database ids
+
+    read(name):
+        read one csv into a BrewBuild object
+
+    iter_dir(directory, pattern):
+        lazily read every csv in a directory into BrewBuild objects
+
+    NOTE: the BrewBuild objects share the ingredient tables loaded
+          by the reader, so they do not query the database themselves
+
+    read_batch(names):
+        read many csvs straight into a RecipeBatch
+    """
+
+    def __init__(self, con):
+        self.con = con
+        self.tables = load_tables(con)
+        # name -> ids of the rows with that name, one per distinct set
+        # of properties (copies with the same properties give the
+        # same results, so the first is used)
+        self.ids = {}
+        self.props = {}
+        for table, columns in CSV_MATCH.items():
+            df = self.tables[table][['name'] + columns].reset_index()
+            # names are written without commas
+            df['name'] = df['name'].str.replace(',', '')
+            df = df.drop_duplicates(['name'] + columns)
+            self.ids[table] = {n: g.to_numpy() for n, g in df.groupby('name', sort=False)['id']}
+            self.props[table] = self.tables['rows'][table][columns].to_numpy(dtype=float)
+        # ids that are catalog entries rather than a recipe's copy
+        self.catalog = {}
+        for table in CSV_MATCH:
+            ids = self.tables[table].index.to_numpy()
+            self.catalog[table] = set(ids[_root_ids(con, table, ids) == ids])
+
+        columns = []
+        for c in CSV_STYLE_ROWS.values():
+            columns += [c + '_min', c + '_max']
+        df = self.tables['style'][columns].reset_index()
+        self.styles = {}
+        for row in df.itertuples(index=False):
+            self.styles.setdefault(tuple(row[1:]), row[0])
+
+    def _lookup(self, table, name):
+        """
+        ids of the rows of a table that could be name
+        """
+        try:
+            return self.ids[table][name]
+        except KeyError:
+            raise ValueError("%s '%s' not found in database" % (table, name))
+
+    def _props(self, table, ids):
+        """
+        the CSV_MATCH columns of a table for some ids
+        """
+        return self.props[table][self.tables['positions'][table][np.asarray(ids, dtype=int)]]
+
+    def _pick(self, table, name, ids):
+        """
+        the one id left after checking, or a ValueError. Rows left that
+        all give the values written in the csv can not be told apart,
+        so the catalog entry is used if there is one
+        """
+        if len(ids) > 1:
+            ids = [i for i in ids if i in self.catalog[table]]
+        if len(ids) != 1:
+            raise ValueError("%s '%s' matches %d database rows with the values in the csv"
+                             % (table, name, len(ids)))
+        return ids[0]
+
+    def _resolve_grains(self, recipe):
+        """
+        pick the fermentable ids by the GU of each and the OG and
+        color of the beer, with the same formulas as build_recipe
+        """
+        ferms = recipe['fermentables']
+        target_volume = recipe['target_volume']
+        candidates = []
+        for (name, amount, ftype), GU in zip(ferms, recipe['fermentable_GU']):
+            ids = self._lookup('fermentable', name)
+            if len(ids) > 1 and not np.isnan(GU):
+                # see BrewBuild.calc_GU
+                grain_yield = self._props('fermentable', ids)[:, 0]
+                if ftype == 0:
+                    points = amount * (grain_yield / 100) * 46 * (recipe['mash_efficiency'] / 100)
+                else:
+                    points = amount * (grain_yield / 100) * 46
+                ids = ids[np.array([int(round(x / target_volume, 0)) for x in points]) == GU]
+            candidates.append(ids)
+
+        ambiguous = [i for i, ids in enumerate(candidates) if len(ids) > 1]
+        if len(ambiguous) > 0:
+            # try every choice for the rows left, see BrewBuild.calc_OG
+            # and BrewBuild.calc_color
+            props = [self._props('fermentable', ids) for ids in candidates]
+            choices = []
+            for choice in itertools.product(*[range(len(ids)) for ids in candidates]):
+                OG_GU = 0
+                MCU = 0.
+                for i, j in enumerate(choice):
+                    grain_yield, color = props[i][j]
+                    if ferms[i][2] == 0:
+                        OG_GU += ferms[i][1] * (grain_yield / 100) * 46 * (recipe['mash_efficiency'] / 100)
+                    else:
+                        OG_GU += ferms[i][1] * (grain_yield / 100) * 46
+                    MCU += (ferms[i][1] * color) / target_volume
+                OG = round((OG_GU / target_volume) / 1000 + 1, 3)
+                color = round(1.4922 * (MCU ** 0.6859), 1)
+                if OG != recipe['OG'] and not np.isnan(recipe['OG']):
+                    continue
+                if color != recipe['color'] and not np.isnan(recipe['color']):
+                    continue
+                choices.append(choice)
+            for i in ambiguous:
+                candidates[i] = candidates[i][sorted(set(c[i] for c in choices))]
+        return np.array([[self._pick('fermentable', n, ids), a, t]
+                         for (n, a, t), ids in zip(ferms, candidates)], dtype=float).reshape(-1, 3)
+
+    def _resolve_hops(self, recipe, grain_bill):
+        """
+        pick the hop ids by the IBU of each, with the same formulas
+        as build_recipe
+        """
+        BG = None
+        hop_bill = []
+        for (name, amount, time), IBU in zip(recipe['hops'], recipe['hop_IBU']):
+            ids = self._lookup('hop', name)
+            if len(ids) > 1 and not np.isnan(IBU):
+                if BG is None:
+                    # see BrewBuild.calc_BG
+                    grain_yield = self._props('fermentable', grain_bill[:, 0])[:, 0]
+                    BG_GU = 0
+                    for i in range(len(grain_bill)):
+                        if grain_bill[i, 2] == 0:
+                            BG_GU += grain_bill[i, 1] * (grain_yield[i] / 100) * 46 * (recipe['mash_efficiency'] / 100)
+                        else:
+                            BG_GU += grain_bill[i, 1] * (grain_yield[i] / 100) * 46
+                    BG = round(BG_GU / recipe['boil_volume'] / 1000 + 1, 3)
+                alpha = self._props('hop', ids)[:, 0]
+                # see BrewBuild.est_hop_IBU
+                fG = 1.65 * 0.000125 ** (BG - 1)
+                fT = (1 - np.exp(-0.04 * time)) / 4.15
+                C_grav = 1 + ((BG - 1.050) / 0.2)
+                est = (amount * (alpha / 100) * fG * fT * 7489) / (recipe['target_volume'] * C_grav)
+                ids = ids[np.array([round(x, 1) for x in est]) == IBU]
+            hop_bill.append([self._pick('hop', name, ids), amount, time])
+        return np.array(hop_bill, dtype=float).reshape(-1, 3)
+
+    def resolve(self, recipe):
+        """
+        turn the names in a recipe from parse_recipe_csv into
+        grain_bill, hop_bill, yeast and style ids
+        """
+        grain_bill = self._resolve_grains(recipe)
+        hop_bill = self._resolve_hops(recipe, grain_bill)
+        # the attenuation is the only yeast property used, so take the
+        # row that has the one in the csv if there is one (an edited
+        # attenuation is put back by read anyway)
+        ids = self._lookup('yeast', recipe['yeast'])
+        if len(ids) > 1:
+            atten = self._props('yeast', ids)[:, 0]
+            ids = ids[np.argmax(atten == recipe['yeast_atten']):]
+        yeast = ids[0]
+
+        style = None
+        ranges = recipe['style_ranges']
+        if len(ranges) == len(CSV_STYLE_ROWS):
+            key = []
+            for c in CSV_STYLE_ROWS.values():
+                key += list(ranges[c])
+            style = self.styles.get(tuple(key))
+        return grain_bill, hop_bill, yeast, style
+
+    def read(self, name):
+        """
+        read one csv written by build_recipe into a BrewBuild object
+        """
+        recipe = parse_recipe_csv(name)
+        grain_bill, hop_bill, yeast, style = self.resolve(recipe)
+        brew = BrewBuild(grain_bill, hop_bill, yeast, recipe['target_volume'],
+                         recipe['boil_volume'], recipe['mash_temp'], self.con,
+                         boil_time=recipe['boil_time'],
+                         mash_efficiency=recipe['mash_efficiency'], style=style,
+                         mash_volume=recipe.get('mash_volume', 1),
+                         tables=self.tables)
+        # keep any attenuation edited in the interactive sheet
+        if brew.df_yeast.loc[0, 'attenuation'] != recipe['yeast_atten']:
+            brew.df_yeast.loc[0, 'attenuation'] = recipe['yeast_atten']
+            brew.clear_metric_cache()
+        return brew
+
+    def iter_dir(self, directory, pattern='*.csv'):
+        """
+        lazily read every csv in directory into BrewBuild objects,
+        yielding (file name, BrewBuild) pairs
+        """
+        for name in sorted(glob.iglob(os.path.join(directory, pattern))):
+            yield name, self.read(name)
+
+    def read_batch(self, names):
+        """
+        read many csvs straight into a RecipeBatch, without
+        creating a BrewBuild object for each one
+        """
+        grain, hops, scalars = [], [], []
+        for name in names:
+            recipe = parse_recipe_csv(name)
+            grain_bill, hop_bill, yeast, style = self.resolve(recipe)
+            grain.append(grain_bill)
+            hops.append(hop_bill)
+            scalars.append((yeast, recipe['target_volume'], recipe['boil_volume'],
+                            recipe['mash_temp'], recipe['boil_time'],
+                            recipe['mash_efficiency'],
+                            -1 if style is None else style,
+                            recipe.get('mash_volume', 1), recipe['yeast_atten']))
+        grain_offsets = np.concatenate([[0], np.cumsum([len(g) for g in grain])])
+        hop_offsets = np.concatenate([[0], np.cumsum([len(h) for h in hops])])
+        grain = np.concatenate(grain) if len(grain) > 0 else np.zeros((0, 3))
+        hops = np.concatenate(hops) if len(hops) > 0 else np.zeros((0, 3))
+        scalars = np.array(scalars, dtype=float).reshape(-1, 9)
+        return RecipeBatch(grain_offsets, grain[:, 0], grain[:, 1], grain[:, 2],
+                           hop_offsets, hops[:, 0], hops[:, 1], hops[:, 2],
+                           scalars[:, 0], scalars[:, 1], scalars[:, 2],
+                           scalars[:, 3], self.con, boil_time=scalars[:, 4],
+                           mash_efficiency=scalars[:, 5], style=scalars[:, 6],
+                           mash_volume=scalars[:, 7], yeast_atten=scalars[:, 8])
+
+
+def build_from_csv(name, con):
+    """
+    build a BrewBuild object from a recipe csv written
+    by build_recipe
+
+    Parameters
+    ----------
+
+    name: str
+        name of the csv file
+
+    con: sqlite3 connection
+        connection to the sqlite database
+    """
+    return RecipeCSVReader(con).read(name)
+
+
+# scalar values of a BrewBuild that are tracked by RecipeHistory
+HISTORY_SCALARS = ['yeast', 'target_volume', 'boil_volume', 'mash_temp',
+                   'boil_time', 'mash_efficiency', 'style', 'mash_volume',
+                   'yeast_atten']
+
+
+def _brew_state(brew):
+    """
+    get the inputs of a BrewBuild as a dict of bills and scalars
+    """
+    state = {'grain_bill': np.array(brew.grain_bill, dtype=float),
+             'hop_bill': np.array(brew.hop_bill, dtype=float)}
+    for attr in HISTORY_SCALARS[:-1]:
+        state[attr] = getattr(brew, attr)
+    state['yeast_atten'] = float(brew.df_yeast.loc[0, 'attenuation'])
+    return state
+
+
+def _bill_delta(old, new):
+    """
+    get the changed cells between two bills, or the whole
+    new bill if rows were added or removed
+    """
+    if old.shape != new.shape:
+        return ('full', new.copy())
+    rows, cols = np.nonzero(old != new)
+    if len(rows) == 0:
+        return None
+    return ('cells', rows.astype(np.int32), cols.astype(np.int8), new[rows, cols])
+
+
+class RecipeHistory(object):
+    """
+    version history of a recipe that stores the first version and
+    only the changed bill cells and scalars for each later version.
+    A full copy is kept every snapshot_every versions so checking
+    out a version only has to replay a few edits
+
+    Parameters
+    ----------
+
+    brew: BrewBuild
+        the recipe to start the history with (version 0)
+
+    snapshot_every: int
+        number of versions between full copies
+
+    Methods
+    -------
+
+    commit(brew, message):
+        add the current state of brew as a new version
+
+    state(version):
+        get the bills and scalars of a version
+
+    checkout(version):
+        create a BrewBuild object for a version
+
+    diff(version1, version2):
+        get what changed between two versions
+
+    save(name):
+        pickle the history so you can open it later
+    """
+
+    def __init__(self, brew, snapshot_every=10):
+        self.con = brew.con
+        self.tables = brew.tables
+        self.snapshot_every = snapshot_every
+        self.snapshots = {0: _brew_state(brew)}
+        self.deltas = [None]
+        self.messages = [None]
+        # state of the latest version, so commits can diff against it
+        self._head = _brew_state(brew)
+
+    def __len__(self):
+        return len(self.deltas)
+
+    def commit(self, brew, message=None):
+        """
+        add the current state of brew as a new version, storing only
+        what changed since the last version
+
+        Output
+        ------
+
+        version: int
+            number of the new version
+        """
+        state = _brew_state(brew)
+        delta = {}
+        for bill in ['grain_bill', 'hop_bill']:
+            change = _bill_delta(self._head[bill], state[bill])
+            if change is not None:
+                delta[bill] = change
+        scalars = {k: state[k] for k in HISTORY_SCALARS if state[k] != self._head[k]}
+        if len(scalars) > 0:
+            delta['scalars'] = scalars
+
+        version = len(self.deltas)
+        self.deltas.append(delta)
+        self.messages.append(message)
+        if version % self.snapshot_every == 0:
+            self.snapshots[version] = state
+        self._head = state
+        return version
+
+    def state(self, version):
+        """
+        get the bills and scalars of a version as a dict, by replaying
+        the edits since the nearest full copy
+        """
+        if version < -len(self.deltas) or version >= len(self.deltas):
+            raise IndexError("version %d not in history of %d versions" % (version, len(self.deltas)))
+        if version < 0:
+            version += len(self.deltas)
+        start = version - version % self.snapshot_every
+        base = self.snapshots[start]
+        state = dict(base)
+        state['grain_bill'] = base['grain_bill'].copy()
+        state['hop_bill'] = base['hop_bill'].copy()
+        for delta in self.deltas[start + 1:version + 1]:
+            for bill in ['grain_bill', 'hop_bill']:
+                if bill not in delta:
+                    continue
+                change = delta[bill]
+                if change[0] == 'full':
+                    state[bill] = change[1].copy()
+                else:
+                    state[bill][change[1], change[2]] = change[3]
+            state.update(delta.get('scalars', {}))
+        return state
+
+    def checkout(self, version):
+        """
+        create a BrewBuild object for a version
+        """
+        state = self.state(version)
+        brew = BrewBuild(state['grain_bill'], state['hop_bill'], state['yeast'],
+                         state['target_volume'], state['boil_volume'],
+                         state['mash_temp'], self.con, boil_time=state['boil_time'],
+                         mash_efficiency=state['mash_efficiency'],
+                         style=state['style'], mash_volume=state['mash_volume'],
+                         tables=self.tables)
+        if brew.df_yeast.loc[0, 'attenuation'] != state['yeast_atten']:
+            brew.df_yeast.loc[0, 'attenuation'] = state['yeast_atten']
+            brew.clear_metric_cache()
+        return brew
+
+    def diff(self, version1, version2):
+        """
+        get what changed going from version1 to version2
+
+        Output
+        ------
+
+        changes: dict
+            for each changed scalar, a tuple of (old, new). For each
+            changed bill, a list of (row, column, old, new), or a tuple
+            of the (old, new) bills if rows were added or removed
+        """
+        old, new = self.state(version1), self.state(version2)
+        changes = {}
+        for bill in ['grain_bill', 'hop_bill']:
+            change = _bill_delta(old[bill], new[bill])
+            if change is None:
+                continue
+            if change[0] == 'full':
+                changes[bill] = (old[bill], new[bill])
+            else:
+                changes[bill] = [(int(r), int(c), float(old[bill][r, c]), float(v))
+                                 for r, c, v in zip(change[1], change[2], change[3])]
+        for k in HISTORY_SCALARS:
+            if old[k] != new[k]:
+                changes[k] = (old[k], new[k])
+        return changes
+
+    def save(self, name):
+        """
+        pickle the history so you can open it later
+        """
+        history = {'snapshot_every': self.snapshot_every,
+                   'snapshots': self.snapshots,
+                   'deltas': self.deltas,
+                   'messages': self.messages}
+        with open(name, 'wb') as f:
+            pickle.dump(history, f)
+
+
+def history_from_pickle(name, con):
+    """
+    open a RecipeHistory that was saved with RecipeHistory.save
+
+    Parameters
+    ----------
+
+    name: str
+        name of the pickle file
+
+    con: sqlite3 connection
+        connection to the sqlite database
+    """
+    with open(name, 'rb') as f:
+        history = pickle.load(f)
+
+    recipe = RecipeHistory.__new__(RecipeHistory)
+    recipe.con = con
+    recipe.tables = None
+    recipe.snapshot_every = history['snapshot_every']
+    recipe.snapshots = history['snapshots']
+    recipe.deltas = history['deltas']
+    recipe.messages = history['messages']
+    recipe._head = recipe.state(len(recipe.deltas) - 1)
+    return recipe
+
+
+# ions tracked for brewing water, matching the water table columns
+WATER_IONS = ['calcium', 'magnesium', 'sodium', 'sulfate', 'chloride', 'bicarbonate']
+
+# ppm of each ion (in the order of WATER_IONS) added by 1 gram
+# of salt per gallon of water, from
+# http://howtobrew.com/book/section-3/understanding-the-mash-ph/using-salts-for-brewing-water-adjustment
+WATER_SALTS = {'gypsum': [61.5, 0., 0., 147.4, 0., 0.],
+               'calcium chloride': [72., 0., 0., 0., 127.4, 0.],
+               'epsom salt': [0., 26.1, 0., 103., 0., 0.],
+               'table salt': [0., 0., 103.9, 0., 160.3, 0.],
+               'baking soda': [0., 0., 72.3, 0., 0., 188.7],
+               'chalk': [105.8, 0., 0., 0., 0., 321.4]}
+
+# salt types used by Brewtarget in the salt table
+SALT_TYPES = {1: 'calcium chloride', 2: 'chalk', 3: 'gypsum',
+              4: 'epsom salt', 5: 'table salt', 6: 'baking soda'}
+
+# mash pH model constants. Base malt in distilled water gives a
+# mash pH of about 5.72, darker malts add acidity in proportion
+# to their color (leveling off for roasted malts) and the grist
+# resists pH changes with a buffer capacity of about 40 mEq / kg / pH,
+# see http://braukaiser.com/wiki/index.php/Beer_color_and_mash_pH
+MASH_PH_DI = 5.72
+GRAIN_ACIDITY = 0.45
+GRAIN_ACIDITY_MAX_COLOR = 80.
+GRIST_BUFFER = 40.
+
+
+def load_water_profiles(con):
+    """
+    load the water profiles from the water table
+
+    Parameters
+    ----------
+
+    con: sqlite3 connection
+        connection to the sqlite database
+
+    Output
+    ------
+
+    df: pandas.DataFrame
+        water profiles indexed by id with name and the WATER_IONS
+        columns in ppm
+    """
+    sql_query = "SELECT id, name, %s FROM water WHERE deleted = 0" % ", ".join(WATER_IONS)
+    return pd.read_sql_query(sql_query, con).set_index('id')
+
+
+def load_recipe_salts(con, recipe_ids=None):
+    """
+    load the salt additions of stored recipes from the salt and
+    salt_in_recipe tables
+
+    Parameters
+    ----------
+
+    con: sqlite3 connection
+        connection to the sqlite database
+
+    recipe_ids: list
+        ids of the recipes to load salts for. If None, all are loaded
+
+    Output
+    ------
+
+    df: pandas.DataFrame
+        one row per addition with recipe_id, salt (key of
+        WATER_SALTS) and grams. Acids are not included
+    """
+    sql_query = "SELECT r.recipe_id, s.stype, s.amount FROM salt_in_recipe as r "
+    sql_query += "JOIN salt as s ON s.id = r.salt_id WHERE s.deleted = 0"
+    if recipe_ids is not None:
+        sql_query += " AND r.recipe_id IN (%s)" % ",".join(str(int(i)) for i in recipe_ids)
+    df = pd.read_sql_query(sql_query, con)
+    df = df[df['stype'].isin(list(SALT_TYPES))]
+    return pd.DataFrame({'recipe_id': df['recipe_id'].to_numpy(),
+                         'salt': df['stype'].map(SALT_TYPES).to_numpy(),
+                         'grams': df['amount'].to_numpy() * 1000})
+
+
+def calc_water_profile(water, salts=None):
+    """
+    calculate the ion profile of water after salt additions
+
+    Parameters
+    ----------
+
+    water: np.array
+        ion profile (ppm) of the source water in the order of
+        WATER_IONS, of size (..., 6)
+
+    salts: np.array
+        grams per gallon of each salt in WATER_SALTS (in order),
+        of size (..., n_salts). Broadcasts against water
+
+    Output
+    ------
+
+    profile: np.array
+        ion profile (ppm) of size (..., 6)
+    """
+    water = np.asarray(water, dtype=float)
+    if salts is None:
+        return water
+    return water + np.asarray(salts, dtype=float) @ np.array(list(WATER_SALTS.values()))
+
+
+def calc_residual_alkalinity(profile):
+    """
+    calculate the residual alkalinity (ppm as CaCO3) of water with
+    Kolbach's formula, where calcium and magnesium offset some of the
+    alkalinity from bicarbonate
+
+    Parameters
+    ----------
+
+    profile: np.array
+        ion profile (ppm) in the order of WATER_IONS, of size (..., 6)
+    """
+    profile = np.asarray(profile, dtype=float)
+    calcium, magnesium = profile[..., 0], profile[..., 1]
+    bicarbonate = profile[..., 5]
+    # everything in mEq / L, then converted to ppm as CaCO3
+    alkalinity = bicarbonate / 61.02
+    RA = alkalinity - calcium / 20.04 / 3.5 - magnesium / 12.15 / 7
+    return RA * 50.04
+
+
+def calc_grain_acidity(grain_amounts, grain_colors):
+    """
+    estimate the acidity (mEq) that mashed grains add, in proportion
+    to how much darker they are than base malt
+
+    Parameters
+    ----------
+
+    grain_amounts: np.array
+        amount of each mashed grain in lbs, of size (..., N)
+
+    grain_colors: np.array
+        color of each mashed grain in degrees Lovibond
+    """
+    grain_kg = np.asarray(grain_amounts, dtype=float) / LB_PER_KG
+    color = np.asarray(grain_colors, dtype=float)
+    acidity = GRAIN_ACIDITY * np.clip(color - 2, 0, GRAIN_ACIDITY_MAX_COLOR)
+    return np.sum(grain_kg * acidity, axis=-1)
+
+
+def calc_mash_pH(RA, grain_weight, grain_acidity, water_volume):
+    """
+    predict the mash pH from the water's residual alkalinity and
+    the grist. All inputs broadcast against each other
+
+    Parameters
+    ----------
+
+    RA: np.array
+        residual alkalinity of the mash water in ppm as CaCO3
+
+    grain_weight: np.array
+        lbs of mashed grain
+
+    grain_acidity: np.array
+        acidity (mEq) of the mashed grain, see calc_grain_acidity
+
+    water_volume: np.array
+        gallons of water in the mash
+
+    Output
+    ------
+
+    pH: np.array
+        predicted mash pH, NaN where there is no mashed grain
+    """
+    grain_kg = np.asarray(grain_weight, dtype=float) / LB_PER_KG
+    water_mEq = np.asarray(RA, dtype=float) / 50.04 * np.asarray(water_volume) * L_PER_GAL
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pH = MASH_PH_DI + (water_mEq - grain_acidity) / (GRIST_BUFFER * grain_kg)
+    return np.where(grain_kg > 0, pH, np.nan)
+
+
+def solve_salt_additions(water, target, weights=None, salts=None):
+    """
+    find the non-negative salt additions that bring source water
+    closest (in weighted least squares) to a target ion profile.
+    Every combination of salts is solved at once and the best one
+    that needs no negative additions is kept, which gives the exact
+    non-negative least squares answer for a handful of salts. Water
+    and target broadcast, so passing water as (P, 1, 6) and targets
+    as (1, T, 6) solves every pair in one call
+
+    Parameters
+    ----------
+
+    water: np.array
+        ion profile (ppm) of the source water, of size (..., 6)
+
+    target: np.array
+        ion profile (ppm) to aim for, of size (..., 6)
+
+    weights: np.array
+        weight of each ion in the fit. Default is all 1
+
+    salts: list
+        names of the salts (keys of WATER_SALTS) that may be used.
+        Default is all of them
+
+    Output
+    ------
+
+    additions: np.array
+        grams per gallon of each salt, of size (..., n_salts) with
+        salts in the order of WATER_SALTS (unused ones are 0)
+
+    profile: np.array
+        resulting ion profile (ppm)
+    """
+    water = np.asarray(water, dtype=float)
+    target = np.asarray(target, dtype=float)
+    if weights is None:
+        weights = np.ones(len(WATER_IONS))
+    weights = np.asarray(weights, dtype=float)
+    names = list(WATER_SALTS)
+    allowed = [names.index(n) for n in (names if salts is None else salts)]
+
+    # ion contributions of each salt, as columns, scaled by the weights
+    A = np.array(list(WATER_SALTS.values())).T * weights[:, None]
+    b = (target - water) * weights
+    shape = b.shape[:-1]
+    b = b.reshape(-1, len(WATER_IONS))
+
+    best = np.zeros((len(b), len(names)))
+    best_res = np.sum(b ** 2, axis=-1)
+    for k in range(1, len(allowed) + 1):
+        for subset in itertools.combinations(allowed, k):
+            x = b @ np.linalg.pinv(A[:, subset]).T
+            feasible = np.all(x >= 0, axis=-1)
+            res = np.sum((b - x @ A[:, subset].T) ** 2, axis=-1)
+            better = feasible & (res < best_res - 1e-12)
+            if better.any():
+                rows = np.flatnonzero(better)
+                best[rows] = 0
+                best[np.ix_(rows, subset)] = x[better]
+                best_res = np.where(better, res, best_res)
+
+    additions = best.reshape(shape + (len(names),))
+    return additions, calc_water_profile(water, additions)
+
+
+# BeerXML record tags, the list tag they sit in and the database
+# table they map to
+BEERXML_RECORDS = {'FERMENTABLE': ('FERMENTABLES', 'fermentable'),
+                   'HOP': ('HOPS', 'hop'),
+                   'YEAST': ('YEASTS', 'yeast'),
+                   'STYLE': ('STYLES', 'style')}
+
+# BeerXML tags that do not match their database column name
+# (all others are the column name in upper case)
+BEERXML_COLUMNS = {'fermentable': {'TYPE': 'ftype'},
+                   'hop': {'TYPE': 'htype'},
+                   'yeast': {'TYPE': 'ytype'},
+                   'style': {'TYPE': 's_type'}}
+
+# properties that, along with the name, identify a database row for
+# a BeerXML record, since the database has copies of some ingredients
+# with the same name and different properties
+BEERXML_MATCH = {'fermentable': ['yield', 'color'],
+                 'hop': ['alpha'],
+                 'yeast': ['attenuation'],
+                 'style': ['og_min', 'og_max', 'ibu_min', 'ibu_max', 'color_min', 'color_max']}
+
+
+def _xml_text(elem, tag, default=None):
+    """
+    get the stripped text of a child of elem
+    """
+    child = elem.find(tag)
+    if child is None or child.text is None or child.text.strip() == '':
+        return default
+    return child.text.strip()
+
+
+class BeerXMLReader(object):
+    """
+    read BeerXML files one record at a time (so memory use does
+    not grow with the size of the file). Recipes are yielded as
+    BrewBuild objects and ingredient/style libraries are added
+    to the database in bulk
+
+    Parameters
+    ----------
+
+    con: sqlite3 connection
+        connection to sqlite database
+
+    add_missing: bool
+        if True, ingredients and styles used by a recipe that are not
+        in the database (matched by name and the properties in
+        BEERXML_MATCH) are added to it. Otherwise a ValueError
+        is raised for them
+
+    chunk_size: int
+        number of library records to insert into the database at once
+
+    Methods
+    -------
+
+    iter_recipes(source):
+        lazily read the recipes in a BeerXML file into BrewBuild
+        objects, adding any ingredient libraries in it to the database
+
+    import_file(source):
+        read a whole BeerXML file, adding its ingredients to
+        the database
+    """
+
+    def __init__(self, con, add_missing=True, chunk_size=1000):
+        self.con = con
+        self.add_missing = add_missing
+        self.chunk_size = chunk_size
+
+        self.columns = {}
+        self.ids = {}
+        for table in ['fermentable', 'hop', 'yeast', 'style']:
+            info = con.execute("PRAGMA table_info(%s)" % table).fetchall()
+            # column name -> is it a number
+            self.columns[table] = {c[1]: c[2].lower() in ('real', 'integer', 'int', 'boolean')
+                                   for c in info if c[1] != 'id'}
+            # name -> {properties: id}
+            self.ids[table] = {}
+            self._add_ids(table, 0)
+        self._pending = {table: [] for table in self.ids}
+        self.counts = {table: 0 for table in self.ids}
+
+    def _row(self, table, elem):
+        """
+        get the database columns and values for a BeerXML record
+        """
+        row = {}
+        renames = BEERXML_COLUMNS[table]
+        for child in elem:
+            if len(child) > 0 or child.text is None:
+                continue
+            column = renames.get(child.tag, child.tag.lower())
+            if column not in self.columns[table]:
+                continue
+            value = child.text.strip()
+            if self.columns[table][column]:
+                if value.upper() in ('TRUE', 'FALSE'):
+                    value = int(value.upper() == 'TRUE')
+                else:
+                    try:
+                        value = float(value)
+                    except ValueError:
+                        continue
+            row[column] = value
+        return row
+
+    def _key(self, table, row):
+        """
+        the properties used to match a record to a database row, or
+        None if the record does not have all of them
+        """
+        key = tuple(row.get(c) for c in BEERXML_MATCH[table])
+        if any(not isinstance(v, (int, float)) for v in key):
+            return None
+        return tuple(round(float(v), 6) for v in key)
+
+    def _add_ids(self, table, last_id):
+        """
+        add the database rows of a table after last_id to self.ids
+        """
+        columns = ", ".join('"%s"' % c for c in BEERXML_MATCH[table])
+        sql = "SELECT id, name, %s FROM %s WHERE id > ? ORDER BY id" % (columns, table)
+        for row in self.con.execute(sql, (last_id,)):
+            key = self._key(table, dict(zip(BEERXML_MATCH[table], row[2:])))
+            known = self.ids[table].setdefault(row[1], {})
+            # keep the first id for copies with the same properties
+            if known.get(key) is None:
+                known[key] = row[0]
+
+    def _match(self, table, row):
+        """
+        find the id of the database row matching a record. Gives
+        None if it is queued but not inserted yet and raises a
+        KeyError if there is no match. A record without all the
+        properties to match on takes the first row with its name
+        """
+        known = self.ids[table][row.get('name', '')]
+        key = self._key(table, row)
+        if key is None and len(known) > 0:
+            return next(iter(known.values()))
+        return known[key]
+
+    def _queue(self, table, elem):
+        """
+        queue a library record to be inserted, skipping records
+        that are already in the database
+        """
+        row = self._row(table, elem)
+        if 'name' not in row:
+            return
+        try:
+            self._match(table, row)
+            return
+        except KeyError:
+            pass
+        # placeholder until the row is inserted
+        self.ids[table].setdefault(row['name'], {})[self._key(table, row)] = None
+        self._pending[table].append(row)
+        if len(self._pending[table]) >= self.chunk_size:
+            self._flush(table)
+
+    def _flush(self, table):
+        """
+        insert the queued records of a table with executemany
+        """
+        rows = self._pending[table]
+        if len(rows) == 0:
+            return
+        last_id = self.con.execute("SELECT MAX(id) FROM %s" % table).fetchone()[0] or 0
+        cur = self.con.cursor()
+        # group rows by the columns they have, so each group is one statement
+        groups = {}
+        for row in rows:
+            groups.setdefault(tuple(row), []).append(tuple(row.values()))
+        for columns, values in groups.items():
+            sql = 'INSERT INTO %s(%s) VALUES(%s)' % (table, ",".join('"%s"' % c for c in columns),
+                                                     ",".join("?" * len(columns)))
+            cur.executemany(sql, values)
+        self.con.commit()
+        self._add_ids(table, last_id)
+        self.counts[table] += len(rows)
+        self._pending[table] = []
+
+    def _lookup(self, table, elem):
+        """
+        get the id of an ingredient used in a recipe, adding it
+        to the database if needed
+        """
+        row = self._row(table, elem)
+        try:
+            i = self._match(table, row)
+        except KeyError:
+            if not self.add_missing:
+                raise ValueError("%s '%s' not found in database" % (table, row.get('name', '')))
+            self._queue(table, elem)
+            i = None
+        if i is None:
+            # still queued, from a library in the same file or just now
+            self._flush(table)
+            i = self._match(table, row)
+        return i
+
+    def _recipe(self, elem):
+        """
+        turn a RECIPE element into a BrewBuild object
+        """
+        grain_bill = []
+        for f in elem.iter('FERMENTABLE'):
+            ftype = _xml_text(f, 'TYPE', 'Grain')
+            grain_bill.append([self._lookup('fermentable', f),
+                               float(_xml_text(f, 'AMOUNT', 0)) * LB_PER_KG,
+                               0 if ftype in ('Grain', 'Adjunct') else 1])
+        hop_bill = []
+        for h in elem.iter('HOP'):
+            # dry hops add no bitterness
+            time = 0. if _xml_text(h, 'USE', 'Boil') == 'Dry Hop' else float(_xml_text(h, 'TIME', 0))
+            hop_bill.append([self._lookup('hop', h),
+                             float(_xml_text(h, 'AMOUNT', 0)) * OZ_PER_KG, time])
+        yeast = elem.find('YEASTS/YEAST')
+        if yeast is None:
+            raise ValueError("recipe '%s' has no yeast" % _xml_text(elem, 'NAME', ''))
+        yeast = self._lookup('yeast', yeast)
+        style = elem.find('STYLE')
+        if style is not None:
+            style = self._lookup('style', style)
+
+        mash_temp = 152.
+        mash_volume = 1.
+        step = elem.find('MASH/MASH_STEPS/MASH_STEP')
+        if step is not None:
+            mash_temp = float(_xml_text(step, 'STEP_TEMP', 66.67)) * 9 / 5 + 32
+            mash_volume = float(_xml_text(step, 'INFUSE_AMOUNT', L_PER_GAL)) / L_PER_GAL
+
+        return BrewBuild(np.array(grain_bill, dtype=float).reshape(-1, 3),
+                         np.array(hop_bill, dtype=float).reshape(-1, 3), yeast,
+                         float(_xml_text(elem, 'BATCH_SIZE', 0)) / L_PER_GAL,
+                         float(_xml_text(elem, 'BOIL_SIZE', 0)) / L_PER_GAL,
+                         mash_temp, self.con,
+                         boil_time=float(_xml_text(elem, 'BOIL_TIME', 60)),
+                         mash_efficiency=float(_xml_text(elem, 'EFFICIENCY', 70)),
+                         style=style, mash_volume=mash_volume)
+
+    def iter_recipes(self, source):
+        """
+        lazily read the recipes in a BeerXML file, yielding
+        (recipe name, BrewBuild) pairs. Ingredient and style
+        records outside of recipes are added to the database
+
+        Parameters
+        ----------
+
+        source: str or file object
+            the BeerXML file
+        """
+        # elements that have started but not ended yet
+        stack = []
+        in_recipe = 0
+        try:
+            for event, elem in ET.iterparse(source, events=('start', 'end')):
+                if event == 'start':
+                    stack.append(elem)
+                    in_recipe += elem.tag == 'RECIPE'
+                    continue
+                stack.pop()
+                if elem.tag == 'RECIPE':
+                    in_recipe -= 1
+                    yield _xml_text(elem, 'NAME', ''), self._recipe(elem)
+                elif (elem.tag in BEERXML_RECORDS and in_recipe == 0 and len(stack) > 0 and
+                      stack[-1].tag == BEERXML_RECORDS[elem.tag][0]):
+                    self._queue(BEERXML_RECORDS[elem.tag][1], elem)
+                # done with this record (whether it was used or not, e.g.
+                # MISC or WATER), so drop it from the tree to keep memory
+                # use constant. Records in a recipe go with the recipe
+                if (in_recipe == 0 and len(stack) > 0 and
+                        (stack[-1].tag == elem.tag + 'S' or len(stack) == 1)):
+                    stack[-1].remove(elem)
+        finally:
+            for table in self._pending:
+                self._flush(table)
+
+    def import_file(self, source):
+        """
+        read a whole BeerXML file, adding its ingredient and style
+        libraries (and any ingredients its recipes use) to the database
+
+        Output
+        ------
+
+        counts: dict
+            number of records added to each table
+        """
+        for _ in self.iter_recipes(source):
+            pass
+        return dict(self.counts)
+
+
+def _xml_record(tag, fields):
+    """
+    build a BeerXML record element from a dict of tag: value
+    """
+    elem = ET.Element(tag)
+    for k, v in fields.items():
+        if v is None or (isinstance(v, float) and np.isnan(v)):
+            continue
+        if isinstance(v, (bool, np.bool_)):
+            v = 'TRUE' if v else 'FALSE'
+        ET.SubElement(elem, k).text = str(v)
+    return elem
+
+
+def _db_record(tag, table, df_row):
+    """
+    build a BeerXML record from a row of a database table
+    """
+    renames = {v: k for k, v in BEERXML_COLUMNS[table].items()}
+    fields = {'VERSION': 1}
+    for column, value in df_row.items():
+        if column in ('id', 'deleted', 'display', 'folder', 'inventory_id',
+                      'display_unit', 'display_scale'):
+            continue
+        fields[renames.get(column, column.upper())] = value
+    return _xml_record(tag, fields)
+
+
+class BeerXMLWriter(object):
+    """
+    write BrewBuild objects to a BeerXML file one recipe at a time,
+    so the whole document is never held in memory. Use as a context
+    manager, or call close when done
+
+    Parameters
+    ----------
+
+    name: str
+        name of the BeerXML file to write
+
+    Methods
+    -------
+
+    write(brew, name):
+        add a BrewBuild object to the file as a recipe
+
+    close():
+        finish the document and close the file
+    """
+
+    def __init__(self, name):
+        self.f = open(name, 'w', encoding='utf-8')
+        self.f.write('<?xml version="1.0" encoding="UTF-8"?>\n<RECIPES>\n')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, brew, name='Recipe'):
+        """
+        add a BrewBuild object to the file as a recipe called name
+        """
+        types = set(np.asarray(brew.grain_bill)[:, 2])
+        if types == {0}:
+            recipe_type = 'All Grain'
+        elif types == {1}:
+            recipe_type = 'Extract'
+        else:
+            recipe_type = 'Partial Mash'
+
+        recipe = _xml_record('RECIPE', {'NAME': name, 'VERSION': 1, 'TYPE': recipe_type,
+                                        'BREWER': '',
+                                        'BATCH_SIZE': brew.target_volume * L_PER_GAL,
+                                        'BOIL_SIZE': brew.boil_volume * L_PER_GAL,
+                                        'BOIL_TIME': brew.boil_time,
+                                        'EFFICIENCY': brew.mash_efficiency,
+                                        'OG': brew.OG, 'FG': brew.FG})
+        if brew.style is not None:
+            recipe.append(_db_record('STYLE', 'style', brew.df_style.iloc[0]))
+
+        hops = ET.SubElement(recipe, 'HOPS')
+        df_hop = brew.df_hop_bill.set_index('id', drop=False)
+        for hop_id, amount, time in brew.hop_bill:
+            row = df_hop.loc[hop_id].copy()
+            row['amount'] = amount / OZ_PER_KG
+            row['time'] = time
+            row['use'] = 'Boil'
+            hops.append(_db_record('HOP', 'hop', row))
+
+        ferms = ET.SubElement(recipe, 'FERMENTABLES')
+        df_grain = brew.df_grain_bill.set_index('id', drop=False)
+        for grain_id, amount, grain_type in brew.grain_bill:
+            row = df_grain.loc[grain_id].copy()
+            row['amount'] = amount / LB_PER_KG
+            ferms.append(_db_record('FERMENTABLE', 'fermentable', row))
+
+        ET.SubElement(recipe, 'MISCS')
+        yeasts = ET.SubElement(recipe, 'YEASTS')
+        yeasts.append(_db_record('YEAST', 'yeast', brew.df_yeast.iloc[0]))
+        ET.SubElement(recipe, 'WATERS')
+
+        mash = _xml_record('MASH', {'NAME': 'Single Infusion', 'VERSION': 1,
+                                    'GRAIN_TEMP': 20.})
+        steps = ET.SubElement(mash, 'MASH_STEPS')
+        steps.append(_xml_record('MASH_STEP', {'NAME': 'Conversion', 'VERSION': 1,
+                                               'TYPE': 'Infusion',
+                                               'INFUSE_AMOUNT': brew.mash_volume * L_PER_GAL,
+                                               'STEP_TEMP': (brew.mash_temp - 32) * 5 / 9,
+                                               'STEP_TIME': 60.}))
+        recipe.append(mash)
+
+        self.f.write(ET.tostring(recipe, encoding='unicode'))
+        self.f.write('\n')
+
+    def close(self):
+        """
+        finish the document and close the file
+        """
+        if not self.f.closed:
+            self.f.write('</RECIPES>\n')
+            self.f.close()
+
+
+def write_beerxml(brews, name, names=None):
+    """
+    write BrewBuild objects to a BeerXML file
+
+    Parameters
+    ----------
+
+    brews: iterable
+        BrewBuild objects to write. Can be a generator, as
+        recipes are written one at a time
+
+    name: str
+        name of the BeerXML file
+
+    names: iterable
+        names of the recipes. Default is 'Recipe 1', 'Recipe 2', ...
+    """
+    with BeerXMLWriter(name) as writer:
+        for i, brew in enumerate(brews):
+            writer.write(brew, 'Recipe %d' % (i + 1) if names is None else names[i])
+
+
+# scales that put OG (in gravity points), IBU and SRM on a
+# similar footing to the ingredient fractions in RecipeIndex
+SIMILARITY_SCALES = {'OG': 100., 'IBU': 100., 'color': 40.}
+
+
+class RecipeIndex(object):
+    """
+    index for finding the stored recipes most similar to some recipe.
+    Each recipe is a sparse vector of its fermentables (by fraction
+    of the grain bill mass) and hops (by fraction of the hop mass)
+    plus its OG, IBU and SRM, and similarity is the cosine between
+    vectors. Recipes can be added at any time (e.g. each time one is
+    saved)
+
+    Parameters
+    ----------
+
+    grain_weight: float
+        weight of the fermentable fractions in the vectors
+
+    hop_weight: float
+        weight of the hop fractions in the vectors
+
+    metric_weight: float
+        weight of the OG, IBU and SRM (scaled by SIMILARITY_SCALES)
+
+    merge_every: int
+        number of recently added recipes kept in a separate block
+        before they are merged into the main matrix (and number of
+        removed recipes kept before their rows are dropped)
+
+    Methods
+    -------
+
+    add_batch(batch, keys):
+        add every recipe in a RecipeBatch to the index
+
+    add_brews(brews, keys):
+        add BrewBuild objects to the index
+
+    add_recipe_table(con, recipe_ids):
+        add stored recipes from the database to the index
+
+    remove(keys):
+        remove recipes from the index
+
+    query(brew, k):
+        find the k recipes in the index most similar to a BrewBuild
+
+    query_batch(batch, k):
+        find the k most similar recipes for every recipe in a RecipeBatch
+    """
+
+    def __init__(self, grain_weight=1., hop_weight=1., metric_weight=1.,
+                 merge_every=1000):
+        self.grain_weight = grain_weight
+        self.hop_weight = hop_weight
+        self.metric_weight = metric_weight
+        self.merge_every = merge_every
+
+        self.keys = []
+        self._rows = {}
+        self._active = np.zeros(0, dtype=bool)
+        self._matrix = sparse.csr_matrix((0, 0))
+        self._recent = []
+        # recipes ever added, for default keys as rows get dropped
+        self._added = 0
+
+    def __len__(self):
+        return int(self._active.sum())
+
+    def _vectors(self, batch):
+        """
+        build the unit length vectors for every recipe in a RecipeBatch.
+        Column 0-2 are OG, IBU and SRM, then fermentable and hop ids
+        alternate (3 + 2 id and 4 + 2 id) so new ids never move columns
+        """
+        n = len(batch)
+        grain_counts = np.diff(batch.grain_offsets)
+        hop_counts = np.diff(batch.hop_offsets)
+        grain_total = _segment_sum(batch.grain_amounts, batch.grain_offsets)
+        hop_total = _segment_sum(batch.hop_amounts, batch.hop_offsets)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            grain_frac = batch.grain_amounts / np.repeat(grain_total, grain_counts)
+            hop_frac = batch.hop_amounts / np.repeat(hop_total, hop_counts)
+
+        metrics = batch.calc_metrics()
+        metric_values = np.column_stack([(metrics['OG'].to_numpy() - 1) * 1000 / SIMILARITY_SCALES['OG'],
+                                         metrics['IBU'].to_numpy() / SIMILARITY_SCALES['IBU'],
+                                         metrics['color'].to_numpy() / SIMILARITY_SCALES['color']])
+
+        rows = np.concatenate([np.repeat(np.arange(n), 3),
+                               np.repeat(np.arange(n), grain_counts),
+                               np.repeat(np.arange(n), hop_counts)])
+        # recipes hold their own copies of ingredients, so compare by parent
+        grain_ids = _root_ids(batch.con, 'fermentable', batch.grain_ids)
+        hop_ids = _root_ids(batch.con, 'hop', batch.hop_ids)
+        cols = np.concatenate([np.tile([0, 1, 2], n),
+                               3 + 2 * grain_ids.astype(np.int64),
+                               4 + 2 * hop_ids.astype(np.int64)])
+        data = np.concatenate([self.metric_weight * metric_values.ravel(),
+                               self.grain_weight * np.nan_to_num(grain_frac),
+                               self.hop_weight * np.nan_to_num(hop_frac)])
+        n_cols = cols.max() + 1 if len(cols) > 0 else 3
+        vectors = sparse.csr_matrix((data, (rows, cols)), shape=(n, n_cols))
+        vectors.sum_duplicates()
+
+        norms = np.sqrt(np.asarray(vectors.multiply(vectors).sum(axis=1)).ravel())
+        norms[norms == 0] = 1
+        return sparse.csr_matrix(sparse.diags(1 / norms) @ vectors)
+
+    @staticmethod
+    def _resize(matrix, n_cols):
+        matrix = matrix.tocsr()
+        if matrix.shape[1] < n_cols:
+            matrix.resize((matrix.shape[0], n_cols))
+        return matrix
+
+    def add_batch(self, batch, keys=None):
+        """
+        add every recipe in a RecipeBatch to the index. A key that is
+        already in the index replaces the old recipe
+
+        Parameters
+        ----------
+
+        batch: RecipeBatch
+            the recipes to add
+
+        keys: list
+            key for each recipe (e.g. a recipe id or file name).
+            Default is the number of recipes added before each one
+        """
+        if keys is None:
+            keys = list(range(self._added, self._added + len(batch)))
+        keys = list(keys)
+        self._added += len(keys)
+        self.remove([k for k in keys if k in self._rows])
+        for k in keys:
+            self._rows[k] = len(self.keys)
+            self.keys.append(k)
+        self._active = np.concatenate([self._active, np.ones(len(keys), dtype=bool)])
+
+        self._recent.append(self._vectors(batch))
+        if sum(m.shape[0] for m in self._recent) >= self.merge_every:
+            self._merge()
+
+    def add_brews(self, brews, keys=None):
+        """
+        add BrewBuild objects to the index, see add_batch
+        """
+        self.add_batch(RecipeBatch.from_brews(brews), keys=keys)
+
+    def add_recipe_table(self, con, recipe_ids=None):
+        """
+        add stored recipes from the database to the index, keyed by
+        recipe id
+        """
+        batch = RecipeBatch.from_recipe_table(con, recipe_ids=recipe_ids)
+        keys = load_recipe_table(con, recipe_ids=recipe_ids)['recipes']['id'].tolist()
+        self.add_batch(batch, keys=keys)
+
+    def remove(self, keys):
+        """
+        remove recipes from the index by key
+        """
+        for k in keys:
+            self._active[self._rows.pop(k)] = False
+        if len(self._active) - len(self._rows) >= self.merge_every:
+            self._merge()
+
+    def _merge(self):
+        """
+        merge the recently added vectors into the main matrix and
+        drop the rows of removed recipes
+        """
+        blocks = [self._matrix] + self._recent
+        n_cols = max(m.shape[1] for m in blocks)
+        matrix = sparse.vstack([self._resize(m, n_cols) for m in blocks], format='csr')
+        self._matrix = matrix[self._active]
+        self._recent = []
+        self.keys = [k for k, active in zip(self.keys, self._active) if active]
+        self._rows = {k: i for i, k in enumerate(self.keys)}
+        self._active = np.ones(len(self.keys), dtype=bool)
+
+    def _similarity(self, vectors):
+        """
+        cosine similarity of each vector with every indexed recipe,
+        of size (number of vectors, recipes in index)
+        """
+        blocks = [self._matrix] + self._recent
+        n_cols = max([m.shape[1] for m in blocks] + [vectors.shape[1]])
+        vectors = self._resize(vectors, n_cols)
+        query = vectors.T.toarray()
+        sims = np.vstack([self._resize(m, n_cols) @ query for m in blocks]).T
+        sims[:, ~self._active] = -np.inf
+        return sims
+
+    def query_batch(self, batch, k=10):
+        """
+        find the k indexed recipes most similar to every recipe
+        in a RecipeBatch
+
+        Output
+        ------
+
+        df: pandas.DataFrame
+            query (position in batch), rank, key and similarity
+            for the k best matches of each query
+        """
+        sims = self._similarity(self._vectors(batch))
+        k = min(k, len(self))
+        if k == 0:
+            return pd.DataFrame(columns=['query', 'rank', 'key', 'similarity'])
+        top = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+        top_sims = np.take_along_axis(sims, top, axis=1)
+        order = np.argsort(-top_sims, axis=1)
+        top = np.take_along_axis(top, order, axis=1)
+        top_sims = np.take_along_axis(top_sims, order, axis=1)
+        keys = [self.keys[i] for i in top.ravel()]
+        return pd.DataFrame({'query': np.repeat(np.arange(len(batch)), k),
+                             'rank': np.tile(np.arange(1, k + 1), len(batch)),
+                             'key': keys,
+                             'similarity': top_sims.ravel()})
+
+    def query(self, brew, k=10):
+        """
+        find the k indexed recipes most similar to a BrewBuild
+
+        Output
+        ------
+
+        df: pandas.DataFrame
+            key and similarity of the k best matches, most similar first
+        """
+        df = self.query_batch(RecipeBatch.from_brews([brew]), k=k)
+        return df[['key', 'similarity']].reset_index(drop=True)
+
+
+# materialized recipe metrics table: metric name, table column and
+# style table columns for the range it is checked against
+METRICS_TABLE = 'recipe_metrics'
+METRICS_COLUMNS = OrderedDict([('OG', ('og', 'og')), ('FG', ('fg', 'fg')),
+                               ('ABV', ('abv', 'abv')), ('IBU', ('ibu', 'ibu')),
+                               ('color', ('color', 'color')), ('BG', ('bg', None))])
+
+
+def create_metrics_table(con):
+    """
+    create the recipe_metrics table (if it does not exist yet) with
+    one row per stored recipe holding its metrics, a style check flag
+    for each metric (1 in range, 0 out of range, NULL with no style),
+    in_style (all checks pass) and the signature of the inputs the
+    metrics were calculated from. Every metric column is indexed
+
+    Parameters
+    ----------
+
+    con: sqlite3 connection
+        connection to the sqlite database
+    """
+    columns = ["recipe_id integer PRIMARY KEY", "signature varchar(16)", "style_id integer"]
+    for name, (col, style_col) in METRICS_COLUMNS.items():
+        columns.append("%s real" % col)
+        if style_col is not None:
+            columns.append("%s_ok boolean" % col)
+    columns.append("in_style boolean")
+    cur = con.cursor()
+    cur.execute("CREATE TABLE IF NOT EXISTS %s(%s)" % (METRICS_TABLE, ", ".join(columns)))
+    for col in [c for c, _ in METRICS_COLUMNS.values()] + ['in_style', 'style_id']:
+        cur.execute("CREATE INDEX IF NOT EXISTS %s_%s_idx ON %s(%s)" % (METRICS_TABLE, col, METRICS_TABLE, col))
+    con.commit()
+
+
+def _hash_rows(df, key):
+    """
+    order independent hash of the rows of df for each value of key,
+    as a uint64 pandas.Series indexed by key
+    """
+    hashes = pd.util.hash_pandas_object(df.drop(columns=key), index=False)
+    return hashes.groupby(df[key].to_numpy()).sum()
+
+
+def recipe_signatures(con, recipe_ids=None):
+    """
+    signature of everything the metrics of each stored recipe are
+    calculated from: the recipe's sizes, times, efficiency, style
+    ranges and mash schedule and the amounts and properties of its
+    fermentables, hops and yeast. Editing a recipe or any ingredient
+    it uses changes its signature
+
+    Parameters
+    ----------
+
+    con: sqlite3 connection
+        connection to the sqlite database
+
+    recipe_ids: list
+        ids of recipes. If None, all recipes that are not deleted
+
+    Output
+    ------
+
+    signatures: pandas.Series
+        hex signature of each recipe, indexed by recipe id
+    """
+    # the recipe's own ingredient rows, which is what gets edited
+    tables = load_recipe_table(con, recipe_ids=recipe_ids, resolve_parents=False)
+    recipes = tables['recipes']
+    catalog = _load_catalog(con)
+    ids = recipes['id'].to_numpy()
+
+    ferms = tables['fermentables'].copy()
+    ferms['yield'] = _catalog_values(catalog, 'fermentable_yield', ferms['id'])
+    ferms['color'] = _catalog_values(catalog, 'fermentable_color', ferms['id'])
+    hops = tables['hops'].copy()
+    hops['alpha'] = _catalog_values(catalog, 'hop_alpha', hops['id'])
+    yeast = tables['yeast'].copy()
+    yeast['attenuation'] = _catalog_values(catalog, 'yeast_attenuation', yeast['id'])
+
+    style_cols = [c + sfx for _, c in METRICS_COLUMNS.values() if c is not None for sfx in ['_min', '_max']]
+    styles = pd.read_sql_query("SELECT id, %s FROM style" % ", ".join(style_cols), con).set_index('id')
+    style_ranges = styles.reindex(recipes['style_id'].to_numpy())
+    style_ranges['recipe_id'] = ids
+
+    mash_ids = recipes['mash_id'].dropna().unique()
+    mash = pd.DataFrame({'recipe_id': ids})
+    if len(mash_ids) > 0:
+        schedules = load_mash_schedules(con, mash_ids)
+        steps = np.column_stack([schedules['grain_temp'], schedules['step_temp'],
+                                 schedules['step_time'], schedules['infuse_volume']])
+        steps = pd.DataFrame(steps, index=schedules['mash_id'])
+        mash = mash.join(steps.reindex(recipes['mash_id'].to_numpy()).reset_index(drop=True))
+
+    # each part is hashed separately and scaled by a different odd
+    # number so that, e.g., a hop row can not cancel a fermentable row
+    signature = _hash_rows(recipes.drop(columns='name'), 'id').reindex(ids)
+    parts = [ferms, hops, yeast, style_ranges, mash]
+    for scale, df in zip([3, 5, 7, 11, 13], parts):
+        part = _hash_rows(df, 'recipe_id').reindex(ids, fill_value=0)
+        signature = signature + part.astype(np.uint64) * np.uint64(scale)
+    return pd.Series(['%016x' % h for h in signature.to_numpy(dtype=np.uint64)], index=ids)
+
+
+def refresh_metrics(con, recipe_ids=None, force=False):
+    """
+    bring the recipe_metrics table up to date. Only recipes whose
+    signature (see recipe_signatures) differs from the stored one are
+    recalculated, in one RecipeBatch, and rows of recipes that were
+    deleted are dropped. Creates the table if needed, so the first
+    call fills it for the whole library
+
+    Parameters
+    ----------
+
+    con: sqlite3 connection
+        connection to the sqlite database
+
+    recipe_ids: list
+        ids of recipes to check. If None, all recipes are checked
+
+    force: bool
+        if True, recalculate every recipe checked even if its
+        signature has not changed
+
+    Output
+    ------
+
+    refreshed: list
+        ids of the recipes that were recalculated
+    """
+    create_metrics_table(con)
+    signatures = recipe_signatures(con, recipe_ids=recipe_ids)
+    stored = pd.read_sql_query("SELECT recipe_id, signature FROM %s" % METRICS_TABLE, con)
+    stored = stored.set_index('recipe_id')['signature']
+
+    cur = con.cursor()
+    if recipe_ids is None:
+        gone = stored.index.difference(signatures.index)
+        cur.executemany("DELETE FROM %s WHERE recipe_id = ?" % METRICS_TABLE,
+                        [(int(i),) for i in gone])
+
+    if force:
+        changed = signatures.index.to_numpy()
+    else:
+        changed = signatures.index[signatures != stored.reindex(signatures.index)].to_numpy()
+    if len(changed) > 0:
+        batch = RecipeBatch.from_recipe_table(con, recipe_ids=changed)
+        metrics = batch.calc_metrics()
+        styles = pd.read_sql_query("SELECT * FROM style", con).set_index('id')
+        ranges = styles.reindex(batch.style)
+        has_style = (batch.style >= 0) & ranges['og_min'].notna().to_numpy()
+
+        df = pd.DataFrame({'recipe_id': changed.astype(int),
+                           'signature': signatures[changed].to_numpy(),
+                           'style_id': np.where(batch.style >= 0, batch.style, None)})
+        in_style = has_style.copy()
+        for name, (col, style_col) in METRICS_COLUMNS.items():
+            df[col] = metrics[name].to_numpy()
+            if style_col is not None:
+                ok = ((df[col].to_numpy() >= ranges[style_col + '_min'].to_numpy()) &
+                      (df[col].to_numpy() <= ranges[style_col + '_max'].to_numpy()))
+                in_style &= ok
+                df[col + '_ok'] = np.where(has_style, ok.astype(int), None)
+        df['in_style'] = np.where(has_style, in_style.astype(int), None)
+
+        values = [tuple(None if pd.isna(v) else v.item() if hasattr(v, 'item') else v for v in row)
+                  for row in df.itertuples(index=False)]
+        sql = 'INSERT OR REPLACE INTO %s(%s) VALUES(%s)' % (METRICS_TABLE, ",".join(df.columns),
+                                                             ",".join("?" * len(df.columns)))
+        cur.executemany(sql, values)
+    con.commit()
+    return changed.tolist()
+
+
+def query_metrics(con, in_style=None, style_id=None, order_by=None, limit=None, **ranges):
+    """
+    find stored recipes by their metrics in the recipe_metrics table
+    (see refresh_metrics), e.g. query_metrics(con, OG=(1.060, None),
+    IBU=(None, 30)) for every recipe with OG >= 1.060 and IBU <= 30
+
+    Parameters
+    ----------
+
+    con: sqlite3 connection
+        connection to the sqlite database
+
+    in_style: bool
+        if not None, only recipes that are (True) or are not (False)
+        within all ranges of their style
+
+    style_id: int
+        if not None, only recipes of this style
+
+    order_by: str
+        metric to sort by (e.g. 'IBU', or '-IBU' for descending)
+
+    limit: int
+        most recipes to return
+
+    **ranges: tuple
+        (min, max) for any of OG, FG, ABV, IBU, color and BG, both
+        inclusive. Either end can be None for no limit
+
+    Output
+    ------
+
+    df: pandas.DataFrame
+        recipe_id, name and the recipe_metrics columns of every
+        matching recipe
+    """
+    where = []
+    params = []
+    for name, (low, high) in ranges.items():
+        if name not in METRICS_COLUMNS:
+            raise ValueError("unknown metric '%s', use one of %s" % (name, list(METRICS_COLUMNS)))
+        col = METRICS_COLUMNS[name][0]
+        if low is not None:
+            where.append("m.%s >= ?" % col)
+            params.append(float(low))
+        if high is not None:
+            where.append("m.%s <= ?" % col)
+            params.append(float(high))
+    if in_style is not None:
+        where.append("m.in_style = ?")
+        params.append(int(in_style))
+    if style_id is not None:
+        where.append("m.style_id = ?")
+        params.append(int(style_id))
+
+    sql_query = "SELECT m.recipe_id, r.name, m.* FROM %s as m " % METRICS_TABLE
+    sql_query += "JOIN recipe as r ON r.id = m.recipe_id"
+    if len(where) > 0:
+        sql_query += " WHERE " + " AND ".join(where)
+    if order_by is not None:
+        name = order_by.lstrip('-')
+        if name not in METRICS_COLUMNS:
+            raise ValueError("unknown metric '%s', use one of %s" % (name, list(METRICS_COLUMNS)))
+        sql_query += " ORDER BY m.%s %s" % (METRICS_COLUMNS[name][0], 'DESC' if order_by.startswith('-') else 'ASC')
+    if limit is not None:
+        sql_query += " LIMIT ?"
+        params.append(int(limit))
+    df = pd.read_sql_query(sql_query, con, params=params)
+    return df.loc[:, ~df.columns.duplicated()]